@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+#
+# This is file `bench_text.py'.
+#
+# Micro-benchmark of the text transform of twoot.py. Each stage of the
+# transform is timed separately on the corpus (text_corpus.json), with link
+# expansion and the Twitter API stubbed out, and the final texts are checked
+# against the golden expectations: text_golden.json for the default transform
+# (mentions are escaped) and text_golden_mapped.json for the transform with
+# mentions mapped by the static MENTION_MAP.
+#
+
+import os
+import sys
+import json
+import time
+
+from docopt import docopt
+import html2text
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import twoot  # noqa: E402
+
+HELP = """Micro-benchmark of the text transform of twoot.py.
+
+Usage:
+    bench_text.py [options]
+
+Options:
+    -h, --help               Show this screen and exit.
+    -n N, --number=N         Repeat each stage N times [default: 200].
+    -b FILE, --baseline=FILE Compare the timings with the baseline FILE.
+    -t X, --tolerance=X      Allowed slowdown against the baseline
+                             [default: 1.5].
+    --save-baseline          Save the timings to the baseline FILE.
+    --update-golden          Update the golden expectations.
+"""
+
+CORPUS_FILE = os.path.join(BENCH_DIR, 'text_corpus.json')
+GOLDEN_FILES = {
+    'escaped': os.path.join(BENCH_DIR, 'text_golden.json'),
+    'mapped': os.path.join(BENCH_DIR, 'text_golden_mapped.json'),
+}
+STAGES = [
+    'html2text', 'expand_links', 'escape_mentions', 'map_mentions',
+    'strip_spaces', 'rt_cite', 'total'
+]
+ROUNDS = 5
+MIN_DELTA = 20.0  # usec; smaller differences are just noises
+MENTION_MAP = {
+    'alice_tw': 'alice@mstdn.example',
+    'bob_tw': 'bob@other.example',
+}
+
+
+# stubs
+class StubResponse:
+    def __init__(self, url):
+        # expand t.co links deterministically; the others are not redirected
+        self.headers = {}
+        if url.startswith('https://t.co/'):
+            self.headers['location'] = 'https://expanded.example/' + url[13:]
+
+
+class StubHTTP:
+    def head(self, url, **kwargs):
+        return StubResponse(url)
+
+
+class StubTwitter:
+    """Answer the previous tweet of rt_cite with a retweet."""
+
+    def __getattr__(self, attr):
+        return self
+
+    def __call__(self, **kwargs):
+        rt = {'id': 1234567890, 'user': {'screen_name': 'alice'}}
+        return [{'retweeted_status': rt}]
+
+
+def make_twoot(mapped=True):
+    """Make a Twoot instance only for the text transform.
+
+    Args:
+        mapped (bool): map mentions by MENTION_MAP (otherwise escape them)
+    """
+    t = twoot.Twoot.__new__(twoot.Twoot)
+    t.config = {
+        'rt_cite': [r'\[RT\]'],
+        'mastodon': {
+            'instance': 'https://mstdn.example'
+        }
+    }
+    t.data = {'twitter_account': {'id': 1}}
+    t.mentions = None
+    if mapped:
+        t.mentions = twoot.MentionMap({'map': MENTION_MAP, 'learn': False})
+    t.http = StubHTTP()
+    t.twitter = StubTwitter()
+
+    t.html2text = html2text.HTML2Text()
+    t.html2text.body_width = 0
+
+    return t
+
+
+def stage_functions(t):
+    """Returns the stage functions of the Twoot instance `t`."""
+    def private(name):
+        return getattr(t, '_Twoot__' + name)
+
+    def total(entry):
+        text = private('pre_process')(entry['input'],
+                                      remove_words=entry.get(
+                                          'remove_words', []),
+                                      origin=entry['kind'],
+                                      mentions=entry.get('mentions', []))
+        if entry.get('rt_cite', False):
+            text = private('replace_rt_cite')(text, 1234567891)
+        return text
+
+    return {
+        'html2text': private('html2text'),
+        'expand_links': private('expand_links'),
+        'escape_mentions': private('escape_mentions'),
+        'map_mentions': lambda x: private('map_mentions')(*x),
+        'strip_spaces': private('strip_spaces'),
+        'rt_cite': lambda text: private('replace_rt_cite')(text, 1234567891),
+        'total': total,
+    }
+
+
+def stage_inputs(funcs, entry):
+    """Returns the actual input of each stage for `entry`."""
+    inputs = {'html2text': entry['input'], 'total': entry}
+
+    text = funcs['html2text'](entry['input'])
+    inputs['expand_links'] = text
+
+    text = funcs['expand_links'](text)
+    for w in entry.get('remove_words', []):
+        text = text.replace(w, '')
+    inputs['escape_mentions'] = text
+    inputs['map_mentions'] = (text, entry['kind'], entry.get('mentions', []))
+
+    text = funcs['map_mentions'](inputs['map_mentions'])
+    inputs['strip_spaces'] = text
+
+    if entry.get('rt_cite', False):
+        inputs['rt_cite'] = funcs['strip_spaces'](text)
+
+    return inputs
+
+
+def bench(corpus, number):
+    """Time each stage on the corpus.
+
+    Returns:
+        dict: the time (usec) of each stage for the whole corpus
+        dict: the final texts of each entry for each kind of golden files
+    """
+    funcs = stage_functions(make_twoot())
+    escaped = stage_functions(make_twoot(mapped=False))
+    timings = {s: 0.0 for s in STAGES}
+    outputs = {kind: {} for kind in GOLDEN_FILES}
+
+    for entry in corpus:
+        inputs = stage_inputs(funcs, entry)
+        outputs['mapped'][entry['name']] = funcs['total'](entry)
+        outputs['escaped'][entry['name']] = escaped['total'](entry)
+
+        for stage in STAGES:
+            if stage not in inputs:
+                continue
+
+            # the best of rounds to reduce noises
+            f, x, best = funcs[stage], inputs[stage], None
+            for _ in range(ROUNDS):
+                start = time.perf_counter()
+                for _ in range(number):
+                    f(x)
+                t = time.perf_counter() - start
+                best = t if best is None else min(best, t)
+            timings[stage] += best / number * 1e6
+
+    return timings, outputs
+
+
+def check_golden(outputs, golden_file):
+    """Returns the names of entries differ from the golden expectations."""
+    with open(golden_file) as f:
+        golden = json.load(f)
+
+    failed = []
+    for name, text in outputs.items():
+        if golden.get(name, None) != text:
+            print('Golden mismatch: {} ({})'.format(
+                name, os.path.basename(golden_file)))
+            print('  expected: {!r}'.format(golden.get(name, None)))
+            print('  actual:   {!r}'.format(text))
+            failed.append(name)
+
+    return failed
+
+
+def check_baseline(timings, baseline_file, tolerance):
+    """Returns the stages slower than the baseline times `tolerance`."""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+
+    failed = []
+    for stage in STAGES:
+        base = baseline.get(stage, 0)
+        delta = timings[stage] - base
+        if base > 0 and timings[stage] > base * tolerance and \
+                delta > MIN_DELTA:
+            print('Regression: {} ({:.1f} usec > {:.1f} usec * {})'.format(
+                stage, timings[stage], base, tolerance))
+            failed.append(stage)
+
+    return failed
+
+
+def main():
+    args = docopt(HELP)
+    number = int(args['--number'])
+    baseline_file = args['--baseline']
+
+    with open(CORPUS_FILE) as f:
+        corpus = json.load(f)
+
+    timings, outputs = bench(corpus, number)
+
+    # report
+    print('{} entries, {} times each'.format(len(corpus), number))
+    for stage in STAGES:
+        print('{:<16} {:>10.1f} usec'.format(stage, timings[stage]))
+
+    # golden expectations
+    if args['--update-golden']:
+        for kind, golden_file in GOLDEN_FILES.items():
+            with open(golden_file, 'w') as f:
+                json.dump(outputs[kind], f, indent=4, sort_keys=True,
+                          ensure_ascii=False)
+                f.write('\n')
+            print('Updated {}'.format(golden_file))
+    elif [n for kind, golden_file in GOLDEN_FILES.items()
+          for n in check_golden(outputs[kind], golden_file)]:
+        return 1
+
+    # timing regressions
+    if baseline_file and args['--save-baseline']:
+        with open(baseline_file, 'w') as f:
+            json.dump(timings, f, indent=4, sort_keys=True)
+            f.write('\n')
+        print('Saved the baseline to {}'.format(baseline_file))
+    elif baseline_file and check_baseline(timings, baseline_file,
+                                          float(args['--tolerance'])):
+        return 2
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
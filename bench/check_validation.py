@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+#
+# This is file `check_validation.py'.
+#
+# Regression checks of the validation of posts (PostValidator) and the
+# splitting of posts into threads, with the Mastodon and Twitter APIs
+# stubbed out. Exits with a non-zero status if any check fails.
+#
+
+import os
+import sys
+import json
+import tempfile
+import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import twoot  # noqa: E402
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+LONG_TEXT = ' '.join('word{}'.format(i) for i in range(80))
+SOURCE_URL = 'https://mstdn.example/@me/9'
+
+
+# stubs
+class StubMastodon:
+    """Record the posted toots."""
+
+    def __init__(self, *args, **kwargs):
+        self.posted = []
+
+    def account_verify_credentials(self):
+        return {'id': 1, 'acct': 'me'}
+
+    def instance(self):
+        return {'configuration': {'statuses': {'max_characters': 500}}}
+
+    def status_post(self, text, **kwargs):
+        self.posted.append(text)
+        return {'id': 10000 + len(self.posted), 'created_at': NOW}
+
+
+class StubTwitter:
+    """Record the posted tweets."""
+
+    def __init__(self, *args, **kwargs):
+        self.posted = []
+
+    def __getattr__(self, attr):
+        return StubCall(self, attr)
+
+
+class StubCall:
+    def __init__(self, stub, path):
+        self.stub, self.path = stub, path
+
+    def __getattr__(self, attr):
+        return StubCall(self.stub, self.path + '/' + attr)
+
+    def __call__(self, **kwargs):
+        if self.path == 'account/verify_credentials':
+            return {'id': 2, 'screen_name': 'me'}
+        if self.path == 'statuses/update':
+            self.stub.posted.append(kwargs)
+            return {
+                'id': 50000 + len(self.stub.posted),
+                'created_at': NOW.strftime('%a %b %d %H:%M:%S +0000 %Y')
+            }
+        raise KeyError(self.path)
+
+
+def make_twoot(home):
+    """Make a Twoot instance with the stub clients and the thread policy.
+
+    Returns:
+        tuple: the Twoot instance and the stub clients
+    """
+    os.environ['HOME'] = home
+    os.makedirs(os.path.join(home, '.twoot.py'))
+    config = {
+        'mastodon': {
+            'instance': 'https://mstdn.example',
+            'access_token': 'token'
+        },
+        'twitter': {
+            'consumer_key': 'key',
+            'consumer_secret': 'secret',
+            'access_token': 'token',
+            'access_token_secret': 'secret'
+        },
+        'validation': {
+            'policy': 'thread'
+        }
+    }
+    with open(os.path.join(home, '.twoot.py', 'default.json'), 'w') as f:
+        json.dump(config, f)
+
+    mastodon, twitter = StubMastodon(), StubTwitter()
+    twoot.Mastodon = lambda *args, **kwargs: mastodon
+    twoot.Twitter.Twitter = lambda *args, **kwargs: twitter
+    return twoot.Twoot('default'), mastodon, twitter
+
+
+def make_toot(id, content):
+    return {
+        'id': id,
+        'content': content,
+        'in_reply_to_account_id': None,
+        'in_reply_to_id': None,
+        'reblog': None,
+        'media_attachments': [],
+        'mentions': [],
+        'created_at': NOW,
+        'visibility': 'public',
+        'sensitive': False,
+        'url': SOURCE_URL,
+        'account': {'id': 1}
+    }
+
+
+def make_tweet(id, text, in_reply_to_id):
+    return {
+        'id': id,
+        'full_text': text,
+        'in_reply_to_user_id': 2,
+        'in_reply_to_status_id': in_reply_to_id,
+        'entities': {'user_mentions': [], 'hashtags': [], 'urls': []},
+        'created_at': NOW.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+        'user': {'id': 2, 'screen_name': 'me'}
+    }
+
+
+# checks
+def check_length():
+    """The weighted length of Twitter."""
+    v = twoot.PostValidator('twitter', twoot.TWITTER_LIMITS)
+    return [
+        ('cjk', v.length('日本語'), 6),
+        ('url', v.length('see https://example.com/a/very/long/path'), 27),
+        ('emoji', v.length('👨‍👩‍👧‍👦 a'), 4),
+    ]
+
+
+def check_plans():
+    """The plans of each policy for a long text with too many media."""
+    media = [twoot.MediaInfo('image', 'https://i.example/{}.png'.format(i))
+             for i in range(5)]
+    res = []
+    for policy in ('truncate', 'thread'):
+        v = twoot.PostValidator('twitter', twoot.TWITTER_LIMITS, policy)
+        plan = v.plan(LONG_TEXT, media, SOURCE_URL) or []
+        valid = all(v.length(t) <= 280 and len(m) <= 4 for t, m in plan)
+        res.append((policy + ' valid', valid and len(plan) > 0, True))
+        res.append((policy + ' media', sum(len(m) for _, m in plan),
+                    4 if policy == 'truncate' else 5))
+
+    v = twoot.PostValidator('twitter', twoot.TWITTER_LIMITS, 'skip')
+    res.append(('skip', v.plan(LONG_TEXT, media, SOURCE_URL), None))
+    return res
+
+
+def check_thread_pairs():
+    """The continuation of a thread is never forwarded back."""
+    with tempfile.TemporaryDirectory() as home:
+        t, mastodon, twitter = make_twoot(home)
+        t.toots2tweets(
+            [twoot.Post.from_toot(make_toot(9, '<p>' + LONG_TEXT + '</p>'))])
+        tweets = twitter.posted
+        first, cont = 50001, 50000 + len(tweets)
+
+        # the next fetch of the tweets has the continuation (a self reply)
+        t.tweets2toots(
+            [twoot.Post.from_tweet(make_tweet(cont, 'continued', first))])
+
+        return [
+            ('thread tweets', len(tweets) > 1, True),
+            ('thread reply', tweets[-1].get('in_reply_to_status_id'),
+             50000 + len(tweets) - 1),
+            ('paired tweet', t._Twoot__find_paired_tweet(9), first),
+            ('forwarded back', mastodon.posted, []),
+        ]
+
+
+def main():
+    failed = 0
+    for check in (check_length, check_plans, check_thread_pairs):
+        for name, actual, expected in check():
+            if actual != expected:
+                print('Failed: {} ({})'.format(name, check.__doc__))
+                print('  expected: {!r}'.format(expected))
+                print('  actual:   {!r}'.format(actual))
+                failed += 1
+
+    if failed:
+        return 1
+
+    print('All checks passed')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,6 +8,7 @@ setup(
     author='Takuto ASAKURA (wtsnjp)',
     author_email='wtsnjp@gmail.com',
     install_requires=[
-        'docopt', 'Mastodon.py', 'twitter', 'html2text', 'requests'
+        'docopt', 'Mastodon.py>=1.8', 'twitter', 'html2text', 'requests'
     ],
+    extras_require={'media': ['Pillow']},
     url='https://github.com/wtsnjp/twoot.py')
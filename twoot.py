@@ -14,19 +14,46 @@
 # basic libraries
 import os
 import re
+import io
+import sys
+import glob
+import copy
+import gzip
 import json
+import math
+import time
 import fcntl
+import socket
+import tempfile
 import pickle
+import cProfile
+import hashlib
+import resource
+import threading
+import tracemalloc
+import multiprocessing
+import unicodedata
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
 from getpass import getpass
+from urllib.error import HTTPError, URLError
 from urllib.parse import urlparse
 
 # pypi libraries
 from docopt import docopt
-from mastodon import Mastodon
+from mastodon import Mastodon, MastodonNetworkError, MastodonServerError
 import twitter as Twitter
 import html2text
 import requests
 
+# optional pypi libraries
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
 # use logger
 import logging as log
 from logging.handlers import RotatingFileHandler
@@ -42,18 +69,1355 @@ Options:
     -d, --debug              Show debug messages.
     -h, --help               Show this screen and exit.
     -l FILE, --log=FILE      Output messages to FILE.
+    --log-format=FMT         Format of messages: text or json [default: text].
+    --log-sample=SPEC        Sample debug events, e.g., "toot.posted=0.1,...".
     -n, --dry-run            Show what would have been transferred.
     -p NAME, --profile=NAME  Use profile NAME.
+    --profile-cpu=FILE       Dump CPU profile (pstats) of each run to FILE.
+    --profile-memory         Report memory usage of each run.
+    -P NAMES, --profiles=NAMES
+                             Use profiles NAMES (comma separated).
+    -a, --all-profiles       Use all profiles.
+    -j N, --jobs=N           Run N profiles in parallel [default: 1].
     -q, --quiet              Show less messages.
     -s, --setup              Execute setup mode.
+    --stats                  Show statistics of sync lags and exit.
+    --resync=WINDOW          Re-sync posts in WINDOW (SINCE[..UNTIL]) and exit.
+    --resync-ranges=N        Fetch the window in N ranges in parallel
+                             [default: 4].
     -u, --update             Update data (only effective with -n).
     -v, --version            Show version.
+    -w, --watch              Keep running and poll repeatedly.
+    --interval=SEC           Polling interval for --watch [default: 60].
+    --record=FILE            Record all HTTP exchanges to cassette FILE.
+    --replay=FILE            Replay HTTP exchanges from cassette FILE.
+    --latency-scale=SCALE    Scale replayed latencies by SCALE [default: 1].
 """.format(p=PROG_NAME)
 VERSION = "1.5.0"
 
 logger = log.getLogger('twoot')
 
 
+# logging context of the current thread (e.g., profile)
+_log_context = threading.local()
+
+
+class ContextFilter(log.Filter):
+    """Add the logging context (profile) of the current thread to records."""
+
+    def filter(self, record):
+        record.profile = getattr(_log_context, 'profile', '-')
+        return True
+
+
+# structured logging
+def log_event(level, event, msg, *args, **fields):
+    """Log a structured event lazily.
+
+    The message is formatted with `args` (in the %-style of logging) and the
+    `fields` are serialized only when the event is actually emitted. Fields
+    can also be callables, which are evaluated only on emission.
+
+    Args:
+        level (int): the log level
+        event (str): the name of the event, e.g., 'toot.posted'
+        msg (str): the human-readable message
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={'event': event, 'fields': fields})
+
+
+class JsonFormatter(log.Formatter):
+    """Format log records as JSON lines."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'name': record.name,
+            'level': record.levelname,
+            'profile': getattr(record, 'profile', '-'),
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+        }
+
+        fields = getattr(record, 'fields', {})
+        for k, v in fields.items():
+            entry[k] = v() if callable(v) else v
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class EventSampler(log.Filter):
+    """Sample noisy debug events.
+
+    For each event with a rate r (0 <= r <= 1), only a fraction r of its
+    debug records are passed. The sampling is deterministic; e.g., rate 0.25
+    passes every 4th record. The other records are always passed.
+
+    Args:
+        rates (dict): sampling rates for event names
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.__counts = {}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        rate = self.rates.get(event, None)
+        if rate is None or record.levelno > log.DEBUG:
+            return True
+
+        n = self.__counts.get(event, 0) + 1
+        self.__counts[event] = n
+        return int(n * rate) > int((n - 1) * rate)
+
+
+# default limits of images for each destination
+MEDIA_LIMITS = {
+    'mastodon': {
+        'max_bytes': 8 * 1024 * 1024,
+        'max_side': None,
+        'max_pixels': 3840 * 2160,
+        'formats': ['image/jpeg', 'image/png', 'image/gif', 'image/webp'],
+    },
+    'twitter': {
+        'max_bytes': 5 * 1024 * 1024,
+        'max_side': 4096,
+        'max_pixels': None,
+        'formats': ['image/jpeg', 'image/png', 'image/gif', 'image/webp'],
+    },
+}
+
+
+# media transform
+def _fit_scale(width, height, limits):
+    """Returns the scale to fit an image of the size in `limits`."""
+    scale = 1.0
+    if limits.get('max_side'):
+        scale = min(scale, limits['max_side'] / max(width, height))
+    if limits.get('max_pixels'):
+        scale = min(scale, math.sqrt(limits['max_pixels'] / (width * height)))
+
+    return scale
+
+
+def _encode_image(img, mime_type, quality):
+    """Encode `img` in the format of `mime_type`."""
+    buf = io.BytesIO()
+
+    if mime_type == 'image/png':
+        img.save(buf, format='PNG', optimize=True)
+
+    else:
+        # JPEG and WebP; flatten transparency on a white background
+        if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+            rgba = img.convert('RGBA')
+            bg = Image.new('RGB', rgba.size, (255, 255, 255))
+            bg.paste(rgba, mask=rgba.split()[-1])
+            img = bg
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        fmt = 'WEBP' if mime_type == 'image/webp' else 'JPEG'
+        img.save(buf, format=fmt, quality=quality, optimize=True)
+
+    return buf.getvalue()
+
+
+def transform_image(data, mime_type, limits, quality=85, min_quality=60):
+    """Downscale and re-encode an image to fit `limits`.
+
+    This function is executed in worker processes of `MediaTransformer`, thus
+    it must be a picklable top-level function. The image is returned as is if
+    it already satisfies the limits.
+
+    Args:
+        data (bytes): raw binary data of the image
+        mime_type (str): content type of the image
+        limits (dict): max_bytes, max_side, max_pixels and formats
+        quality (int): the initial quality for lossy formats
+        min_quality (int): the quality never to go below
+
+    Returns:
+        bytes: raw binary data of the (transformed) image
+        str: content type
+    """
+    img = Image.open(io.BytesIO(data))
+    scale = _fit_scale(img.width, img.height, limits)
+    format_ok = mime_type in limits['formats']
+
+    # nothing to do
+    if scale >= 1 and format_ok and len(data) <= limits['max_bytes']:
+        return data, mime_type
+
+    # re-encoding animations is out of our scope
+    if getattr(img, 'is_animated', False):
+        return data, mime_type
+
+    # choose the output format
+    if format_ok and mime_type in ('image/jpeg', 'image/png', 'image/webp'):
+        out_type = mime_type
+    else:
+        out_type = 'image/jpeg'
+
+    img = ImageOps.exif_transpose(img)
+    while True:
+        if scale < 1:
+            size = (max(1, int(img.width * scale)),
+                    max(1, int(img.height * scale)))
+            resized = img.resize(size, Image.LANCZOS)
+        else:
+            resized = img
+
+        out = _encode_image(resized, out_type, quality)
+        if len(out) <= limits['max_bytes']:
+            return out, out_type
+
+        # try lossy compression, lower quality, and then smaller size
+        if out_type == 'image/png' and 'image/jpeg' in limits['formats']:
+            out_type = 'image/jpeg'
+        elif quality - 10 >= min_quality:
+            quality -= 10
+        elif min(resized.size) > 64:
+            scale = min(scale, 1.0) * 0.75
+        else:
+            return out, out_type
+
+
+class CassetteMiss(Exception):
+    """Raised when no recorded exchange is found for a call in replay."""
+    pass
+
+
+class _CassetteProxy:
+    """Proxy of an API client which passes every call to a cassette."""
+
+    def __init__(self, cassette, target, name):
+        self._cassette = cassette
+        self._target = target
+        self._name = name
+
+    def __getattr__(self, attr):
+        target = None
+        if self._target is not None:
+            target = getattr(self._target, attr)
+
+        return _CassetteProxy(self._cassette, target,
+                              '{}.{}'.format(self._name, attr))
+
+    def __call__(self, *args, **kwargs):
+        return self._cassette.call(self._name, self._target, args, kwargs)
+
+
+class Cassette:
+    """Record HTTP exchanges to a file or replay them from the file.
+
+    The exchanges are recorded at the boundary of the API clients (Mastodon,
+    Twitter, and the requests module), so every call made by `Twoot` is
+    captured regardless of the underlying HTTP library. Calls with the same
+    name and arguments are replayed in the recorded order.
+
+    The data files of the profiles at the start of recording are also kept in
+    the cassette, since the arguments of calls (e.g., `since_id`) depend on
+    them. Replays run on temporary copies of them, so the real data files are
+    never touched.
+
+    Args:
+        path (str): the cassette file
+        replay (bool): replay mode if True, otherwise record mode
+        latency_scale (float): scale of latencies in replay (0 for no wait)
+    """
+
+    def __init__(self, path, replay=False, latency_scale=1.0):
+        self.path = path
+        self.replaying = replay
+        self.latency_scale = latency_scale
+        self.__lock = threading.Lock()
+
+        self.__data_files = {}
+        if replay:
+            logger.debug('Loading cassette {}'.format(path))
+            with gzip.open(path, 'rb') as f:
+                cassette = pickle.load(f)
+            exchanges = cassette['exchanges']
+            self.__exchanges = {k: deque(v) for k, v in exchanges.items()}
+            self.__data = cassette.get('data', {})
+        else:
+            self.__exchanges = {}
+            self.__data = {}
+
+    def data_file(self, profile, path):
+        """Returns the data file of `profile` to use with the cassette.
+
+        Args:
+            profile (str): the profile name
+            path (str): the real data file
+
+        Returns:
+            str: `path` for recording, or a temporary copy for replaying
+        """
+        with self.__lock:
+            if profile in self.__data_files:
+                return self.__data_files[profile]
+
+            data = None
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+
+            # keep the data at the start of the recording
+            if not self.replaying:
+                self.__data[profile] = data
+                self.__data_files[profile] = path
+                return path
+
+            if profile in self.__data:
+                data = self.__data[profile]
+            else:
+                logger.warn('No data of {} in the cassette; replaying with a '
+                            'copy of the current data'.format(profile))
+
+            fd, tmp = tempfile.mkstemp(prefix='twoot-replay-',
+                                       suffix='.pickle')
+            os.close(fd)
+            if data is None:
+                os.remove(tmp)
+            else:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+
+            logger.debug('Replaying with the data file {}'.format(tmp))
+            self.__data_files[profile] = tmp
+            return tmp
+
+    def wrap(self, target, name):
+        """Returns a proxy of `target` (None in replay mode)."""
+        if self.replaying:
+            target = None
+
+        return _CassetteProxy(self, target, name)
+
+    @staticmethod
+    def __key(name, args, kwargs):
+        def norm(v):
+            # keep keys compact even for large media data
+            if isinstance(v, (bytes, bytearray)):
+                return 'sha1:' + hashlib.sha1(v).hexdigest()
+            return repr(v)
+
+        items = [norm(a) for a in args]
+        items += ['{}={}'.format(k, norm(kwargs[k])) for k in sorted(kwargs)]
+        return '{}({})'.format(name, ', '.join(items))
+
+    def call(self, name, func, args, kwargs):
+        """Execute (record mode) or replay (replay mode) a call."""
+        key = self.__key(name, args, kwargs)
+
+        # replay mode
+        if self.replaying:
+            with self.__lock:
+                queue = self.__exchanges.get(key)
+                if not queue:
+                    raise CassetteMiss(key)
+                latency, ok, value = queue.popleft()
+
+            if self.latency_scale > 0:
+                time.sleep(latency * self.latency_scale)
+            if not ok:
+                raise value
+            return value
+
+        # record mode
+        start, err = time.time(), None
+        try:
+            value = func(*args, **kwargs)
+        except Exception as e:
+            err = value = e
+        latency = time.time() - start
+
+        # some objects (e.g., HTTP errors with sockets) cannot be stored
+        stored = value
+        try:
+            pickle.dumps(stored)
+        except Exception:
+            logger.warn('Cannot record the result of {}'.format(name))
+            stored = Exception(repr(err)) if err is not None else None
+
+        with self.__lock:
+            self.__exchanges.setdefault(key, []).append(
+                (latency, err is None, stored))
+
+        if err is not None:
+            raise err
+        return value
+
+    def save(self):
+        """Save the recorded exchanges to the cassette file.
+
+        In replay mode, the temporary data files are removed instead.
+        """
+        if self.replaying:
+            for tmp in self.__data_files.values():
+                if os.path.isfile(tmp):
+                    os.remove(tmp)
+            return
+
+        logger.debug('Saving cassette {}'.format(self.path))
+        with self.__lock:
+            exchanges = {k: list(v) for k, v in self.__exchanges.items()}
+            data = dict(self.__data)
+        with gzip.open(self.path, 'wb') as f:
+            pickle.dump({
+                'version': 2,
+                'exchanges': exchanges,
+                'data': data
+            }, f)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the host seems to be down."""
+    pass
+
+
+def _is_outage(e):
+    """Returns True if the exception `e` implies an outage of the host."""
+    if isinstance(e, (requests.exceptions.ConnectionError,
+                      requests.exceptions.Timeout, socket.timeout,
+                      MastodonNetworkError, MastodonServerError)):
+        return True
+
+    if isinstance(e, Twitter.TwitterHTTPError):
+        return e.e.code >= 500
+
+    if isinstance(e, requests.exceptions.HTTPError) and \
+            e.response is not None:
+        return e.response.status_code >= 500
+
+    return isinstance(e, URLError) and not isinstance(e, HTTPError)
+
+
+class CircuitBoard:
+    """Circuit breakers for each host.
+
+    After `failures` consecutive outages of a host, its circuit is opened and
+    all calls to the host fail immediately with CircuitOpenError. Once
+    `reset_after` seconds have passed, the host is probed in the background
+    and the circuit is closed again if the host responds. The state is meant
+    to be persisted across runs.
+
+    Args:
+        config (dict): the `circuit_breaker` section of the config
+        state (dict): the persisted state of hosts
+        timeout: the timeout for probes
+        head: the function for HEAD requests of probes (e.g., through a
+            cassette); requests.head by default
+    """
+
+    def __init__(self, config, state=None, timeout=None, head=None):
+        self.failures = config.get('failures', 3)
+        self.reset_after = config.get('reset_after', 300)
+        self.timeout = timeout
+        self.head = head or requests.head
+        self.state = state or {}
+        self.__lock = threading.Lock()
+        self.__probes = {}
+
+    def is_open(self, host):
+        """Returns True if the circuit of `host` is open."""
+        with self.__lock:
+            st = self.state.get(host, None)
+            opened_at = st.get('opened_at', None) if st else None
+
+        if opened_at is None:
+            return False
+
+        if time.time() - opened_at >= self.reset_after:
+            self.__probe(host)
+
+        return self.state.get(host, {}).get('opened_at', None) is not None
+
+    def __probe(self, host):
+        """Probe `host` in the background (only one at once)."""
+        with self.__lock:
+            if host in self.__probes and self.__probes[host].is_alive():
+                return
+
+            def probe():
+                try:
+                    r = self.head('https://{}/'.format(host),
+                                  timeout=self.timeout)
+                    alive = r.status_code < 500
+                except Exception:
+                    alive = False
+
+                logger.info('Probed {}: {}'.format(
+                    host, 'recovered' if alive else 'still down'))
+                if alive:
+                    self.success(host)
+                else:
+                    with self.__lock:
+                        self.state[host]['opened_at'] = time.time()
+
+            logger.debug('Probing {} in the background'.format(host))
+            th = threading.Thread(target=probe, daemon=True)
+            self.__probes[host] = th
+            th.start()
+
+    def join_probes(self):
+        """Wait for the running probes."""
+        for th in list(self.__probes.values()):
+            th.join()
+
+    def open_circuits(self):
+        """Returns the state of the open circuits (to be persisted)."""
+        with self.__lock:
+            return {
+                host: dict(st)
+                for host, st in self.state.items()
+                if st.get('opened_at', None) is not None
+            }
+
+    def success(self, host):
+        with self.__lock:
+            if host in self.state:
+                logger.debug('Closing the circuit of {}'.format(host))
+                del self.state[host]
+
+    def failure(self, host):
+        with self.__lock:
+            st = self.state.setdefault(host, {'count': 0, 'opened_at': None})
+            st['count'] += 1
+            if st['count'] >= self.failures and st['opened_at'] is None:
+                logger.warn('Opening the circuit of {}'.format(host))
+                st['opened_at'] = time.time()
+
+    def call(self, host, func, *args, **kwargs):
+        """Call `func` unless the circuit of `host` is open."""
+        if self.is_open(host):
+            raise CircuitOpenError(host)
+
+        try:
+            r = func(*args, **kwargs)
+        except Exception as e:
+            if _is_outage(e):
+                self.failure(host)
+            raise
+
+        self.success(host)
+        return r
+
+
+class _GuardedClient:
+    """Proxy of an API client which calls it through a circuit breaker."""
+
+    def __init__(self, board, host, target, **extra):
+        self._board = board
+        self._host = host
+        self._target = target
+        self._extra = extra
+
+    def __getattr__(self, attr):
+        return _GuardedClient(self._board, self._host,
+                              getattr(self._target, attr), **self._extra)
+
+    def __call__(self, *args, **kwargs):
+        kwargs = dict(self._extra, **kwargs)
+        return self._board.call(self._host, self._target, *args, **kwargs)
+
+
+class HttpClient:
+    """Plain HTTP(S) requests with timeouts and circuit breakers.
+
+    Args:
+        board (CircuitBoard): circuit breakers
+        timeout: timeout for requests, i.e., (connect, read)
+    """
+
+    def __init__(self, board, timeout):
+        self.board = board
+        self.timeout = timeout
+
+    def __request(self, method, url, **kwargs):
+        host = urlparse(url).netloc
+        kwargs.setdefault('timeout', self.timeout)
+
+        def request():
+            r = method(url, **kwargs)
+
+            # server errors are also outages
+            if r.status_code >= 500:
+                r.raise_for_status()
+            return r
+
+        try:
+            return self.board.call(host, request)
+        except requests.exceptions.HTTPError as e:
+            return e.response
+
+    def get(self, url, **kwargs):
+        return self.__request(requests.get, url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.__request(requests.head, url, **kwargs)
+
+
+class FilterRule:
+    """A rule to skip posts, compiled from an entry of `filters` config.
+
+    A rule matches a post if all of the given conditions are satisfied:
+
+        * direction: 'toots' (toots -> tweets) or 'tweets' (tweets -> toots)
+        * hashtags: the post has any of the hashtags
+        * keywords: the text contains any of the keywords (ignoring case)
+        * regex: the text matches the regular expression
+        * visibility: the visibility is any of them (toots)
+        * sensitive: the media are marked as sensitive (or not)
+        * has_media: the post has media (or not)
+
+    Rules with unknown keys (e.g., typos) or without any condition are
+    rejected, since they would match every post.
+
+    Args:
+        rule (dict): the rule entry
+    """
+    CONDITIONS = ('direction', 'hashtags', 'keywords', 'regex', 'visibility',
+                  'sensitive', 'has_media')
+
+    def __init__(self, rule):
+        unknown = sorted(set(rule) - set(self.CONDITIONS) - {'name'})
+        if unknown:
+            raise ValueError('Unknown key(s) in filter rule {}: {}'.format(
+                json.dumps(rule, sort_keys=True), ', '.join(unknown)))
+        if not any(k in rule for k in self.CONDITIONS):
+            raise ValueError('No condition in filter rule {}'.format(
+                json.dumps(rule, sort_keys=True)))
+        if rule.get('direction', 'toots') not in ('toots', 'tweets'):
+            raise ValueError('Unknown direction in filter rule {}'.format(
+                json.dumps(rule, sort_keys=True)))
+
+        self.name = rule.get('name', None) or json.dumps(rule, sort_keys=True)
+        self.direction = rule.get('direction', None)
+        self.hashtags = set(t.lstrip('#').lower()
+                            for t in rule.get('hashtags', []))
+        self.visibility = set(rule.get('visibility', []))
+        self.sensitive = rule.get('sensitive', None)
+        self.has_media = rule.get('has_media', None)
+
+        # compile all text conditions once
+        self.keywords = None
+        if rule.get('keywords', None):
+            self.keywords = re.compile(
+                '|'.join(re.escape(k) for k in rule['keywords']),
+                re.IGNORECASE)
+        self.regex = re.compile(rule['regex']) if 'regex' in rule else None
+
+    def matches(self, post, direction, text=None):
+        """Returns True if `post` fetched as `direction` matches the rule.
+
+        Args:
+            post (Post): the post
+            direction (str): 'toots' or 'tweets'
+            text (str): the plain text of the post (default: post.text)
+        """
+        text = post.text if text is None else text
+        if self.direction is not None and self.direction != direction:
+            return False
+        if self.hashtags and self.hashtags.isdisjoint(post.tags):
+            return False
+        if self.visibility and post.visibility not in self.visibility:
+            return False
+        if self.sensitive is not None and post.sensitive != self.sensitive:
+            return False
+        if self.has_media is not None and \
+                (len(post.media) > 0) != self.has_media:
+            return False
+        if self.keywords is not None and not self.keywords.search(text):
+            return False
+        if self.regex is not None and not self.regex.search(text):
+            return False
+
+        return True
+
+
+class Lease:
+    """A leader lease in a file on shared storage.
+
+    Only the holder of an unexpired lease is the leader. The holder renews
+    the lease to keep it, and the other nodes (standbys) can take it over
+    once it has expired, i.e., within `ttl` seconds after the leader is gone.
+    Updates of the lease file are serialized by a lock file created
+    exclusively (which works on NFS unlike flock), and written atomically.
+    Note that the clocks of the nodes must be synchronized.
+
+    Each takeover increments the term of the lease, and `term` is the last
+    one held by this node. The lease is renewed only in the same term, so
+    a node never resumes after the lease has been taken over, and the term
+    can be used as a fencing token.
+
+    Args:
+        path (str): the lease file
+        node_id (str): the name of this node
+        ttl (float): seconds for the lease to expire
+    """
+
+    def __init__(self, path, node_id, ttl=60):
+        self.path = path
+        self.node_id = node_id
+        self.ttl = ttl
+        self.term = None
+
+    def __read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'holder': None, 'expires': 0, 'term': 0}
+
+    def __write(self, lease):
+        tmp = '{}.{}.tmp'.format(self.path, self.node_id)
+        with open(tmp, 'w') as f:
+            json.dump(lease, f)
+        os.replace(tmp, self.path)
+
+    def __update(self, takeover):
+        """Extend the lease if this node holds it (or can take it over)."""
+        mutex = self.path + '.lock'
+        for _ in range(10):
+            try:
+                fd = os.open(mutex, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                # the mutex left by a crashed node
+                try:
+                    if time.time() - os.path.getmtime(mutex) > self.ttl:
+                        os.remove(mutex)
+                        continue
+                except OSError:
+                    pass
+                time.sleep(0.1)
+        else:
+            logger.warn('Failed to lock the lease {}'.format(self.path))
+            return False
+
+        try:
+            now = time.time()
+            lease = self.__read()
+            mine = lease['holder'] == self.node_id and lease['expires'] > now
+
+            # nobody has taken over the lease in the term; still mine
+            if not takeover:
+                mine = lease['holder'] == self.node_id and \
+                    lease.get('term', 0) == self.term
+
+            if not mine:
+                if not takeover or lease['expires'] > now:
+                    return False
+                if lease['holder'] is not None:
+                    logger.info('Taking over the lease {} from {}'.format(
+                        self.path, lease['holder']))
+                lease = {
+                    'holder': self.node_id,
+                    'term': lease.get('term', 0) + 1
+                }
+
+            lease['expires'] = now + self.ttl
+            self.__write(lease)
+            self.term = lease['term']
+            return True
+
+        finally:
+            os.close(fd)
+            os.remove(mutex)
+
+    def acquire(self):
+        """Returns True if this node holds (or has taken over) the lease."""
+        return self.__update(takeover=True)
+
+    def renew(self):
+        """Returns True if this node still holds the lease."""
+        return self.__update(takeover=False)
+
+    def holder(self):
+        return self.__read()['holder']
+
+
+def _parse_twitter_time(s):
+    """Parse a timestamp of Twitter, e.g., 'Wed Oct 10 20:19:24 +0000 2018'."""
+    return datetime.strptime(s, '%a %b %d %H:%M:%S %z %Y')
+
+
+# ids of both services are "snowflakes" embedding the creation time
+TWITTER_EPOCH = 1288834974657  # msec
+
+
+def _twitter_id_at(t):
+    """Returns the smallest possible id of tweets created at `t` (epoch)."""
+    return max(0, int(t * 1000) - TWITTER_EPOCH) << 22
+
+
+def _mastodon_id_at(t):
+    """Returns the smallest possible id of toots created at `t` (epoch)."""
+    return int(t * 1000) << 16
+
+
+def _mastodon_id_time(toot_id):
+    """Returns the creation time (epoch) of the toot `toot_id`."""
+    return (int(toot_id) >> 16) / 1000
+
+
+def _parse_window(spec):
+    """Parse a time window "SINCE[..UNTIL]" of UTC dates or times.
+
+    Args:
+        spec (str): e.g., "2019-01-01", "2019-01-01..2019-02-01T12:00"
+
+    Returns:
+        float: the start (epoch)
+        float: the end (epoch), or None for now
+    """
+    formats = ['%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S']
+
+    def parse(s):
+        for fmt in formats:
+            try:
+                dt = datetime.strptime(s.strip(), fmt)
+                return dt.replace(tzinfo=timezone.utc).timestamp()
+            except ValueError:
+                pass
+        raise ValueError('Invalid date or time: {}'.format(s))
+
+    since, _, until = spec.partition('..')
+    since = parse(since)
+    until = parse(until) if until else None
+    if until is not None and until <= since:
+        raise ValueError('Empty window: {}'.format(spec))
+
+    return since, until
+
+
+class MediaInfo:
+    """A media attachment normalized with just the fields for syncing.
+
+    Attributes:
+        type (str): 'image', 'gifv', or 'video'
+        url (str): the url of the actual data
+        expanded_url (str): the url of the media shown in the text (Twitter)
+    """
+    __slots__ = ('type', 'url', 'expanded_url')
+
+    def __init__(self, type, url, expanded_url=None):
+        self.type = type
+        self.url = url
+        self.expanded_url = expanded_url
+
+    @classmethod
+    def from_twitter(cls, media):
+        types = {'photo': 'image', 'animated_gif': 'gifv'}
+        media_type = types.get(media['type'], media['type'])
+
+        if media_type == 'image':
+            url = media['media_url_https']
+        else:
+            url = media['video_info']['variants'][0]['url']
+
+        return cls(media_type, url, media['expanded_url'])
+
+    @classmethod
+    def from_mastodon(cls, media):
+        return cls(media['type'], media['url'])
+
+    def __repr__(self):
+        return 'MediaInfo({}, {})'.format(self.type, self.url)
+
+
+class Post:
+    """A post (toot or tweet) normalized with just the fields for syncing.
+
+    The raw API responses are projected into posts as soon as they are
+    fetched, so that the large dicts (e.g., nested user objects and entities)
+    can be released during the process.
+
+    Attributes:
+        id (int): Id of the post
+        text (str): the text (HTML for toots)
+        created_at (datetime): the creation time
+        in_reply_to_id (int): Id of the post replied to
+        in_reply_to_account_id (int): Id of the account replied to
+        reblog_id (int): Id of the boosted (retweeted) post
+        media (list): MediaInfo of attachments
+        mentions (list): the mentioned usernames
+        tags (list): the hashtags (in lower case)
+        visibility (str): the visibility ('public' for tweets)
+        sensitive (bool): the media are marked as sensitive
+        url (str): the url of the post
+    """
+    __slots__ = ('id', 'text', 'created_at', 'in_reply_to_id',
+                 'in_reply_to_account_id', 'reblog_id', 'media', 'mentions',
+                 'tags', 'visibility', 'sensitive', 'url')
+
+    def __init__(self, **kwargs):
+        for k in self.__slots__:
+            setattr(self, k, kwargs.get(k, None))
+
+    @classmethod
+    def from_toot(cls, toot):
+        reblog = toot.get('reblog', None)
+        return cls(id=toot['id'],
+                   text=toot['content'],
+                   created_at=toot['created_at'],
+                   in_reply_to_id=toot['in_reply_to_id'],
+                   in_reply_to_account_id=toot['in_reply_to_account_id'],
+                   reblog_id=reblog['id'] if reblog else None,
+                   media=[
+                       MediaInfo.from_mastodon(m)
+                       for m in toot.get('media_attachments', [])
+                   ],
+                   mentions=[m['acct'] for m in toot.get('mentions', [])],
+                   tags=[t['name'].lower() for t in toot.get('tags', [])],
+                   visibility=toot.get('visibility', 'public'),
+                   sensitive=bool(toot.get('sensitive', False)),
+                   url=toot.get('url', None))
+
+    @classmethod
+    def from_tweet(cls, tweet):
+        retweeted = tweet.get('retweeted_status', None)
+        entities = tweet.get('entities', {})
+        screen_name = tweet.get('user', {}).get('screen_name', None)
+        return cls(id=tweet['id'],
+                   text=tweet['full_text'],
+                   created_at=_parse_twitter_time(tweet['created_at']),
+                   in_reply_to_id=tweet.get('in_reply_to_status_id', None),
+                   in_reply_to_account_id=tweet.get('in_reply_to_user_id',
+                                                    None),
+                   reblog_id=retweeted['id'] if retweeted else None,
+                   media=[
+                       MediaInfo.from_twitter(m) for m in tweet.get(
+                           'extended_entities', {}).get('media', [])
+                   ],
+                   mentions=[
+                       m['screen_name']
+                       for m in entities.get('user_mentions', [])
+                   ],
+                   tags=[
+                       t['text'].lower() for t in entities.get('hashtags', [])
+                   ],
+                   visibility='public',
+                   sensitive=bool(tweet.get('possibly_sensitive', False)),
+                   url=screen_name and 'https://twitter.com/{}/status/{}'.
+                   format(screen_name, tweet['id']))
+
+    def __repr__(self):
+        return 'Post({})'.format(', '.join(
+            '{}={!r}'.format(k, getattr(self, k)) for k in self.__slots__))
+
+
+# mentions in texts (including the very beginning); a user name with the host
+# for remote Mastodon accounts
+MENTION_RE = re.compile(r'(?:(?<=[\s(])|^)@(\w+)(@[\w-]+(?:\.[\w-]+)+)?')
+
+# accounts in profiles of the other service (to be confirmed to exist)
+MASTODON_ACCOUNT_RE = re.compile(
+    r'(?<![\w.-])@(\w+)@([\w-]+(?:\.[\w-]+)+)|'
+    r'https://([\w-]+(?:\.[\w-]+)+)/@(\w+)')
+TWITTER_ACCOUNT_RE = re.compile(
+    r'(?<![\w.-])(?:www\.|mobile\.)?(?:twitter|x)\.com/(?:#!/)?@?(\w{1,15})\b')
+TWITTER_RESERVED = ('home', 'i', 'intent', 'search', 'share')
+
+
+class MentionMap:
+    """Map mentions between Twitter handles and Mastodon accounts.
+
+    The mapping in the config is indexed in both directions. The other
+    accounts are looked up (e.g., a Mastodon account in the profile of the
+    Twitter user) at most once in `ttl` seconds, and the results (including
+    misses) are cached in the data file.
+
+    Args:
+        config (dict): the `mentions` section of the config
+        cache (dict): the persisted cache {'service:name': [value, expires]}
+    """
+
+    def __init__(self, config, cache=None):
+        self.learn = config.get('learn', True)
+        self.ttl = config.get('ttl', 7 * 86400)
+        self.max_lookups = config.get('max_lookups', 20)
+        self.cache = dict(cache or {})
+        self.dirty = False
+        self.__lookups = 0
+
+        self.__index = {}
+        for handle, acct in config.get('map', {}).items():
+            handle, acct = handle.lstrip('@'), acct.lstrip('@')
+            self.__index['twitter:' + handle.lower()] = acct
+            self.__index['mastodon:' + acct.lower()] = handle
+
+    def get(self, service, name, lookup=None):
+        """Returns the account of the other service mapped from `name`.
+
+        Args:
+            service (str): 'twitter' or 'mastodon'
+            name (str): a Twitter handle or a Mastodon acct (user@host)
+            lookup (function): look up the account for `name` if not cached
+
+        Returns:
+            str: the mapped account, or None if unknown
+        """
+        key = '{}:{}'.format(service, name.lower())
+        if key in self.__index:
+            return self.__index[key]
+
+        now = time.time()
+        entry = self.cache.get(key, [None, 0])
+        if entry[1] > now:
+            return entry[0]
+
+        # an expired entry is still better than nothing
+        if not self.learn or lookup is None or \
+                self.__lookups >= self.max_lookups:
+            return entry[0]
+
+        self.__lookups += 1
+        try:
+            value = lookup(name)
+        except Exception as e:
+            logger.warn('Failed to look up {}: {}'.format(key, e))
+            return entry[0]
+
+        log_event(log.DEBUG, 'mention.learned', 'Learned %s -> %s', key,
+                  value, key=key, value=value)
+        self.cache[key] = [value, now + self.ttl]
+        self.dirty = True
+        return value
+
+    def prune(self):
+        """Drop the expired cache entries."""
+        now = time.time()
+        self.cache = {k: e for k, e in self.cache.items() if e[1] > now}
+
+
+# limits of posts
+TWITTER_LIMITS = {'max_chars': 280, 'url_length': 23, 'max_media': 4}
+MASTODON_LIMITS = {'max_chars': 500, 'url_length': 23, 'max_media': 4}
+
+URL_RE = re.compile(r'https?://\S+')
+REMOTE_MENTION_RE = re.compile(r'(@\w+)@[\w-]+(?:\.[\w-]+)+')
+EMOJI_RE = re.compile('[\U0001F1E6-\U0001F1FF]{2}|'
+                      '[\u2600-\u27BF\U0001F000-\U0001FAFF]'
+                      '(?:[\uFE0F\U0001F3FB-\U0001F3FF]|'
+                      '\u200D[\u2600-\u27BF\U0001F000-\U0001FAFF])*')
+
+
+def _twitter_weight(text):
+    """Returns the weighted length of `text` (without URLs) for Twitter.
+
+    Latin and general punctuation letters count as 1, and the others (e.g.,
+    CJK letters) as 2. An emoji sequence counts as 2 as a whole.
+    """
+    n = 0
+    for m in EMOJI_RE.finditer(text):
+        n += 2
+    text = EMOJI_RE.sub('', text)
+
+    for c in text:
+        cp = ord(c)
+        if cp <= 4351 or 8192 <= cp <= 8205 or 8208 <= cp <= 8223 or \
+                8242 <= cp <= 8247:
+            n += 1
+        else:
+            n += 2
+
+    return n
+
+
+class PostValidator:
+    """Check posts against the limits of a service before any upload.
+
+    Posts violating the limits are handled by `policy`: 'truncate' them with
+    a link to the original post, split them into a 'thread', or 'skip' them.
+    As for media, a video (or GIF) cannot be posted with any other media.
+
+    Args:
+        service (str): 'twitter' or 'mastodon'
+        limits (dict): max_chars, url_length, and max_media
+        policy (str): 'truncate', 'thread', or 'skip'
+    """
+    ELLIPSIS = '\u2026'
+
+    def __init__(self, service, limits, policy='truncate'):
+        if policy not in ('truncate', 'thread', 'skip'):
+            raise ValueError('Unknown validation policy: {}'.format(policy))
+
+        self.service = service
+        self.max_chars = limits['max_chars']
+        self.url_length = limits['url_length']
+        self.max_media = limits['max_media']
+        self.policy = policy
+
+    def length(self, text):
+        """Returns the length of `text` counted by the service.
+
+        Every URL counts as `url_length`. For Twitter, letters are weighted;
+        for Mastodon, the host of a remote mention does not count.
+        """
+        text = unicodedata.normalize('NFC', text)
+        urls = len(URL_RE.findall(text))
+        text = URL_RE.sub('', text)
+
+        if self.service == 'twitter':
+            n = _twitter_weight(text)
+        else:
+            n = len(REMOTE_MENTION_RE.sub(r'\1', text))
+
+        return n + urls * self.url_length
+
+    def __group_media(self, media):
+        """Group `media` into those can be posted together."""
+        groups, images = [], []
+        for m in media:
+            if m.type == 'image':
+                images.append(m)
+                if len(images) == self.max_media:
+                    groups.append(images)
+                    images = []
+            else:
+                if images:
+                    groups.append(images)
+                    images = []
+                groups.append([m])
+
+        if images:
+            groups.append(images)
+
+        return groups or [[]]
+
+    def __truncate(self, text, suffix):
+        """Truncate `text` at a space to fit in the limit with `suffix`."""
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.length(text[:mid].rstrip() + suffix) <= self.max_chars:
+                lo = mid
+            else:
+                hi = mid - 1
+
+        # never break words (and URLs) unless a word is too long
+        space = max(text.rfind(' ', 0, lo + 1), text.rfind('\n', 0, lo + 1))
+        if lo < len(text) and space > lo // 2:
+            lo = space
+
+        return text[:lo].rstrip()
+
+    def __split(self, text):
+        """Split `text` into parts in the limit at spaces."""
+        parts = []
+        while self.length(text) > self.max_chars:
+            head = self.__truncate(text, '')
+            if not head:
+                break
+            parts.append(head)
+            text = text[len(head):].lstrip()
+
+        if text:
+            parts.append(text)
+
+        return parts
+
+    def plan(self, text, media, url=None):
+        """Plan the posts for `text` and `media` within the limits.
+
+        Args:
+            text (str): the text
+            media (list): MediaInfo of attachments
+            url (str): the url of the original post (for 'truncate')
+
+        Returns:
+            list: the posts (pairs of a text and media) to be posted as a
+                thread, or None to skip
+        """
+        groups = self.__group_media(media)
+        too_long = self.length(text) > self.max_chars
+        if not too_long and len(groups) == 1:
+            return [(text, groups[0])]
+
+        logger.debug('The post violates the limits of {} ({}, {} media)'.
+                     format(self.service, self.length(text), len(media)))
+        if self.policy == 'skip':
+            return None
+
+        if self.policy == 'truncate':
+            if url is None:
+                suffix = self.ELLIPSIS
+            else:
+                suffix = self.ELLIPSIS + ' ' + url
+            if too_long or url is not None:
+                text = self.__truncate(text, suffix) + suffix
+            return [(text, groups[0])]
+
+        # thread
+        texts = self.__split(text)
+        n = max(len(texts), len(groups))
+        texts += [''] * (n - len(texts))
+        groups += [[]] * (n - len(groups))
+
+        return list(zip(texts, groups))
+
+
+class PollScheduler:
+    """Decide when to poll each direction from its recent posting activity.
+
+    The interval of a direction is reset to `min_interval` right after new
+    posts are found, and otherwise multiplied by `backoff` up to
+    `max_interval`. While idle, the interval is also capped by `rate_factor`
+    times the median gap between the latest `history` posts, so that busy
+    accounts are polled often even in short breaks.
+
+    Args:
+        config (dict): the `adaptive_polling` section of the config
+        state (dict): the persisted state of directions
+    """
+
+    def __init__(self, config, state=None):
+        self.min_interval = config.get('min_interval', 15)
+        self.max_interval = config.get('max_interval', 900)
+        self.backoff = config.get('backoff', 2.0)
+        self.rate_factor = config.get('rate_factor', 0.5)
+        self.history = config.get('history', 20)
+        self.state = state or {}
+
+    def due(self, direction, now=None):
+        """Returns True if `direction` should be polled now."""
+        now = now or time.time()
+        return self.state.get(direction, {}).get('next', 0) <= now
+
+    def wait(self, now=None):
+        """Returns seconds until any direction should be polled.
+
+        A direction is overdue (or not scheduled yet) only if it could not
+        be polled (e.g., while the APIs are down); retry it after
+        `min_interval` then, instead of right away.
+        """
+        now = now or time.time()
+        nexts = [st.get('next', 0) for st in self.state.values()]
+        if not nexts or min(nexts) <= now:
+            return self.min_interval
+        return min(nexts) - now
+
+    def update(self, direction, timestamps, active, now=None):
+        """Schedule the next poll of `direction` after a poll.
+
+        Args:
+            direction (str): 'toots' or 'tweets'
+            timestamps (list): creation times (epoch) of the fetched posts
+            active (bool): new posts are found in the poll
+
+        Returns:
+            float: the new interval
+        """
+        now = now or time.time()
+        st = self.state.get(direction, {})
+
+        # posting rate from the latest posts
+        times = sorted(set(st.get('times', []) + timestamps))
+        times = times[-self.history:]
+        gaps = sorted(b - a for a, b in zip(times, times[1:]))
+        gap = gaps[len(gaps) // 2] if gaps else None
+
+        # tighten right after activity, otherwise back off
+        if active:
+            interval = self.min_interval
+        else:
+            interval = st.get('interval', self.min_interval) * self.backoff
+            if gap is not None:
+                interval = min(interval, gap * self.rate_factor)
+        interval = max(self.min_interval, min(self.max_interval, interval))
+
+        self.state[direction] = {
+            'interval': interval,
+            'next': now + interval,
+            'times': times
+        }
+        log_event(log.DEBUG,
+                  'poll.scheduled',
+                  'Next poll of %s in %.0f sec (active: %s, median gap: %s)',
+                  direction,
+                  interval,
+                  active,
+                  gap,
+                  direction=direction,
+                  interval=interval,
+                  active=active,
+                  median_gap=gap)
+
+        return interval
+
+
+class MediaTransformer:
+    """Transform media to fit the limits of destinations in a process pool.
+
+    Transforms are submitted and their futures are returned immediately, so
+    that downloading the other media can go on while the CPU work is done.
+    If the transform is disabled (or Pillow is not installed), the futures
+    just hold the original data. The workers are spawned rather than forked,
+    since profiles run in threads and a forked child could inherit a lock
+    (e.g., of logging) held by another thread.
+
+    Args:
+        config (dict): the `media_transform` section of the config
+    """
+
+    def __init__(self, config=None):
+        self.enabled = config is not None and config.get('enabled', True)
+        if self.enabled and Image is None:
+            logger.warn('Pillow is not installed; media transform disabled')
+            self.enabled = False
+
+        config = config or {}
+        self.workers = max(1, config.get('workers', 2))
+        self.quality = config.get('quality', 85)
+        self.min_quality = config.get('min_quality', 60)
+        self.limits = {
+            dest: dict(limits, **config.get(dest, {}))
+            for dest, limits in MEDIA_LIMITS.items()
+        }
+
+        self.__executor = None
+
+    def submit(self, data, mime_type, dest):
+        """Submit a transform of media for the destination `dest`.
+
+        Args:
+            data (bytes): raw binary data of the media
+            mime_type (str): content type of the media
+            dest (str): 'mastodon' or 'twitter'
+
+        Returns:
+            Future: to be (bytes, str) of the transformed media
+        """
+        if not self.enabled or not mime_type.startswith('image/'):
+            future = Future()
+            future.set_result((data, mime_type))
+            return future
+
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'))
+
+        return self.__executor.submit(transform_image, data, mime_type,
+                                      self.limits[dest], self.quality,
+                                      self.min_quality)
+
+    def shutdown(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+
+
 # the module
 class Twoot:
 
@@ -134,7 +1498,7 @@ class Twoot:
 
         return twitter
 
-    def __init__(self, profile='default', setup=False):
+    def __init__(self, profile='default', setup=False, cassette=None):
         # files
         twoot_dir = os.path.expanduser('~/.' + PROG_NAME)
         if not os.path.isdir(twoot_dir):
@@ -176,24 +1540,88 @@ class Twoot:
             with open(self.config_file) as f:
                 self.config = json.loads(f.read())
 
-            # setup Mastodon
-            ms = self.config['mastodon']
-            # Note: for HTTP debugging, set debug_requests=True
-            self.mastodon = Mastodon(access_token=ms['access_token'],
-                                     api_base_url=ms['instance'],
-                                     user_agent=ms.get('app_name', ''))
-
-            # setup Twitter
-            tw = self.config['twitter']
-            t_auth = Twitter.OAuth(tw['access_token'],
-                                   tw['access_token_secret'],
-                                   tw['consumer_key'], tw['consumer_secret'])
-            self.twitter = Twitter.Twitter(auth=t_auth)
-            self.twitter_upload = Twitter.Twitter(domain='upload.twitter.com',
-                                                  auth=t_auth)
+            # the data may be on shared storage (e.g., for HA)
+            self.data_file = self.config.get('data_file', self.data_file)
+
+            # timeouts and circuit breakers for every outbound call
+            to = self.config.get('timeouts', {})
+            timeout = (to.get('connect', 10), to.get('read', 60))
+            self.circuits = CircuitBoard(
+                self.config.get('circuit_breaker', {}), timeout=timeout)
+            self.api_hosts = [
+                urlparse(self.config['mastodon']['instance']).netloc,
+                'api.twitter.com'
+            ]
+
+            # no real clients are needed for replaying
+            if cassette is not None and cassette.replaying:
+                logger.debug('Replaying cassette {}'.format(cassette.path))
+                self.mastodon = None
+                self.twitter = self.twitter_upload = None
+
+            else:
+                # setup Mastodon
+                ms = self.config['mastodon']
+                # Note: for HTTP debugging, set debug_requests=True
+                self.mastodon = _GuardedClient(
+                    self.circuits, self.api_hosts[0],
+                    Mastodon(access_token=ms['access_token'],
+                             api_base_url=ms['instance'],
+                             user_agent=ms.get('app_name', ''),
+                             request_timeout=timeout))
+
+                # setup Twitter
+                tw = self.config['twitter']
+                t_auth = Twitter.OAuth(tw['access_token'],
+                                       tw['access_token_secret'],
+                                       tw['consumer_key'],
+                                       tw['consumer_secret'])
+                self.twitter = _GuardedClient(self.circuits,
+                                              'api.twitter.com',
+                                              Twitter.Twitter(auth=t_auth),
+                                              _timeout=timeout[1])
+                self.twitter_upload = _GuardedClient(
+                    self.circuits,
+                    'upload.twitter.com',
+                    Twitter.Twitter(domain='upload.twitter.com',
+                                    auth=t_auth),
+                    _timeout=timeout[1])
+
+        # plain HTTP(S) requests (link expansion and media downloads)
+        self.http = requests
+        if not self.setup:
+            self.http = HttpClient(self.circuits, timeout)
+
+        # record or replay every exchange
+        if cassette is not None:
+            if self.setup:
+                logger.warn('Cassettes have no effect for setup mode')
+            else:
+                def wrap(target, name):
+                    return cassette.wrap(target, profile + ':' + name)
+
+                # replay on the data at the start of the recording
+                self.data_file = cassette.data_file(profile, self.data_file)
+
+                self.mastodon = wrap(self.mastodon, 'mastodon')
+                self.twitter = wrap(self.twitter, 'twitter')
+                self.twitter_upload = wrap(self.twitter_upload,
+                                           'twitter_upload')
+                self.http = wrap(self.http, 'http')
+                self.circuits.head = wrap(requests, 'probe').head
+
+        # active/standby high availability
+        self.lease = None
+        if not self.setup and 'ha' in self.config:
+            ha = self.config['ha']
+            self.lease = Lease(ha.get('lease_file', self.data_file + '.lease'),
+                               ha.get('node_id', socket.gethostname()),
+                               ha.get('lease_ttl', 60))
 
         # data
         self.twoots = []
+        self.deleted_twoots = []
+        self.__num_saved = 0
 
         if os.path.isfile(self.data_file):
             logger.debug('Loading data file {}'.format(self.data_file))
@@ -203,7 +1631,16 @@ class Twoot:
             logger.debug('No data file found; initialzing')
             self.data = {'twoots': []}
 
+        if not self.setup:
+            self.circuits.state = copy.deepcopy(self.data.get('circuits', {}))
+
+        # index of twoots; the newest pair wins as in data['twoots']
+        self.__toot_of_tweet, self.__tweet_of_toot = {}, {}
+        for t in reversed(self.data['twoots']):
+            self.__index_twoot(t)
+
         # fetch self account information
+        fetched = not os.path.isfile(self.data_file)
         if not self.data.get('mastodon_account', False):
             ms_avc = self.mastodon.account_verify_credentials
             try:
@@ -211,6 +1648,7 @@ class Twoot:
                     'Fetching Mastodon account information (verify credentials)'
                 )
                 self.data['mastodon_account'] = ms_avc()
+                fetched = True
             except Exception as e:
                 logger.exception(
                     'Failed to verify credentials for Mastodon: {}'.format(e))
@@ -224,19 +1662,71 @@ class Twoot:
                     'Fetching Twitter account information (verify credentials)'
                 )
                 self.data['twitter_account'] = tw_avc()
+                fetched = True
             except Exception as e:
                 logger.exception(
                     'Failed to verify credentials for Twitter: {}'.format(e))
                 logger.critical('Unable to continue; abort!')
                 raise
 
-        # save data anyway
-        with open(self.data_file, 'wb') as f:
-            pickle.dump(self.data, f)
+        # save data if updated; never clobber the data of the leader
+        if fetched:
+            self.__write_data(self.data)
+
+        # filter rules
+        self.filters = [FilterRule(r) for r in self.config.get('filters', [])]
+        self.filter_hits = {}
+
+        # polling schedule
+        self.scheduler = None
+        if 'adaptive_polling' in self.config:
+            self.scheduler = PollScheduler(self.config['adaptive_polling'],
+                                           self.data.get('poll_state', None))
+
+        # mapping of mentions
+        self.mentions = None
+        if 'mentions' in self.config:
+            self.mentions = MentionMap(self.config['mentions'],
+                                       self.data.get('mention_cache', None))
+
+        # validation of posts against the limits of the services
+        self.validation = self.config.get('validation', None)
+        self.__validators = {}
+        if self.validation is not None:
+            self.__validators['twitter'] = PostValidator(
+                'twitter', TWITTER_LIMITS,
+                self.validation.get('policy', 'truncate'))
+
+        # media attached to published toots afterwards; the pending ones of
+        # the previous runs are retried
+        self.deferred_media = []
+        if 'deferred_media' in self.config:
+            self.deferred_media = list(self.data.get('deferred_media', []))
+        self.__resyncing = False
 
         # utility
         self.html2text = html2text.HTML2Text()
         self.html2text.body_width = 0
+        self.media_transformer = MediaTransformer(
+            self.config.get('media_transform', None))
+
+    def __write_data(self, data):
+        """Write `data` to the data file atomically.
+
+        In HA mode, the term of the lease is written as a fencing token, and
+        the data written by a leader of a newer term is never overwritten.
+        """
+        if self.lease is not None and self.lease.term is not None:
+            if data.get('lease_term', 0) > self.lease.term:
+                logger.warn('The data has been taken over (term {}); not '
+                            'saving'.format(data['lease_term']))
+                return
+            data['lease_term'] = self.lease.term
+
+        tmp = '{}.{}.tmp'.format(self.data_file, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(tmp, self.data_file)
 
     def __update_last_id(self, key, value):
         """Update the last id (last_toot or last_tweet) in the data file."""
@@ -249,19 +1739,34 @@ class Twoot:
 
         # update the target
         data[key] = value
-        with open(self.data_file, 'wb') as f:
-            pickle.dump(data, f)
+        self.__write_data(data)
+
+    def __schedule(self, direction, created, active, dry_run, update):
+        """Schedule the next poll of `direction` if adaptive polling is on.
+
+        Args:
+            direction (str): 'toots' or 'tweets'
+            created (list): datetimes of the fetched posts
+            active (bool): new posts are found in the poll
+        """
+        if self.scheduler is None:
+            return
+
+        self.scheduler.update(direction, [c.timestamp() for c in created],
+                              active)
+        if not dry_run or update:
+            self.__update_last_id('poll_state', self.scheduler.state)
 
     def get_new_toots(self, dry_run=False, update=False):
         """Get new toots of the author.
 
         Using account_statuses API, get the author's new toots, i.e., the toots
         from the owner's account since the last toot id, and return the list of
-        toot dicts. If the last toot id cannot be found in the data, the id of
-        latest toot is recoreded and return an empty list.
+        toot posts from the oldest one. If the last toot id cannot be found in
+        the data, the id of latest toot is recoreded and return an empty list.
 
         Returns:
-            list: toot dicts
+            list: toot posts
         """
         res = []
 
@@ -275,21 +1780,31 @@ class Twoot:
             if last_id:
                 logger.debug('Getting new toots for sync')
                 r = self.mastodon.account_statuses(my_id, since_id=last_id)
-
                 logger.debug('Number of new toots: {}'.format(len(r)))
-                res = r
 
             # get toots only for updating last_toot
             else:
                 logger.debug('Getting new toots only for fetching information')
                 r = self.mastodon.account_statuses(my_id)
 
+            # project the toots from the oldest one and release raw dicts
+            posts = [Post.from_toot(t) for t in reversed(r)]
+            del r
+            if last_id:
+                res = posts
+
+            # schedule the next poll
+            self.__schedule('toots', [p.created_at for p in posts],
+                            len(res) > 0, dry_run, update)
+
             # update the last toot ID
-            if len(r) > 0:
-                new_last_id = r[0]['id']  # r[0] is the latest
+            if len(posts) > 0:
+                new_last_id = posts[-1].id  # posts[-1] is the latest
 
-                # update the data file immediately
-                if not dry_run or update:
+                # update the data file immediately; in HA mode, the last id
+                # is updated for each processed toot to be taken over
+                if (not dry_run or update) and \
+                        (self.lease is None or not last_id):
                     logger.debug(
                         'Updating the last toot: {}'.format(new_last_id))
                     self.__update_last_id('last_toot', new_last_id)
@@ -304,11 +1819,12 @@ class Twoot:
 
         Using statuses/user_timeline API, get the author's new tweets, i.e.,
         the tweets from the owner's account since the last tweet id, and return
-        the list of Tweet dicts. If the last tweet id cannot be found in the
-        data, the id of latest tweet is recoreded and return an empty list.
+        the list of tweet posts from the oldest one. If the last tweet id
+        cannot be found in the data, the id of latest tweet is recoreded and
+        return an empty list.
 
         Returns:
-            list: toot dicts
+            list: tweet posts
         """
         res = []
 
@@ -324,9 +1840,7 @@ class Twoot:
                 r = self.twitter.statuses.user_timeline(user_id=my_id,
                                                         since_id=last_id,
                                                         tweet_mode="extended")
-
                 logger.debug('Number of new tweets: {}'.format(len(r)))
-                res = r
 
             # get tweets only for updating last_tweet
             else:
@@ -335,12 +1849,24 @@ class Twoot:
                 r = self.twitter.statuses.user_timeline(user_id=my_id,
                                                         tweet_mode="extended")
 
+            # project the tweets from the oldest one and release raw dicts
+            posts = [Post.from_tweet(t) for t in reversed(r)]
+            del r
+            if last_id:
+                res = posts
+
+            # schedule the next poll
+            self.__schedule('tweets', [p.created_at for p in posts],
+                            len(res) > 0, dry_run, update)
+
             # update the last tweet ID
-            if len(r) > 0:
-                new_last_id = r[0]['id']  # r[0] is the latest
+            if len(posts) > 0:
+                new_last_id = posts[-1].id  # posts[-1] is the latest
 
-                # update the data file immediately
-                if not dry_run or update:
+                # update the data file immediately; in HA mode, the last id
+                # is updated for each processed tweet to be taken over
+                if (not dry_run or update) and \
+                        (self.lease is None or not last_id):
                     logger.debug(
                         'Updating the last tweet: {}'.format(new_last_id))
                     self.__update_last_id('last_tweet', new_last_id)
@@ -350,16 +1876,96 @@ class Twoot:
 
         return res
 
-    def __store_twoot(self, toot_id, tweet_id):
+    def __index_twoot(self, twoot):
+        """Add a twoot to the index of pairs.
+
+        A continuation part of a split post is indexed only as a destination,
+        so that it is never forwarded back while the source post stays
+        paired with the first part.
+        """
+        toot_id, tweet_id = twoot['toot_id'], twoot['tweet_id']
+        if not twoot.get('part', False) or twoot['origin'] == 'toot':
+            self.__toot_of_tweet[tweet_id] = toot_id
+        if not twoot.get('part', False) or twoot['origin'] == 'tweet':
+            self.__tweet_of_toot[toot_id] = tweet_id
+
+    def __store_twoot(self, toot_id, tweet_id, origin, lag=None, part=False):
         """Store a twoot (a pair of toot_id and tweet_id) in the data.
 
         Insert the newest twoot to the HEAD of data['twoot'].
         This is because it makes it easier to keep the number of stored twoots
         less than max_twoots and also efficient in searching calculation.
+
+        Args:
+            toot_id (int): Id of the toot
+            tweet_id (int): Id of the tweet
+            origin (str): the source of the pair ('toot' or 'tweet')
+            lag (dict): the sync lag of the pair
+            part (bool): the destination is a continuation of a split post
         """
-        twoot = {'toot_id': toot_id, 'tweet_id': tweet_id}
-        logger.debug('Storing a twoot: {}'.format(twoot))
+        twoot = {'toot_id': toot_id, 'tweet_id': tweet_id, 'origin': origin}
+        if part:
+            twoot['part'] = True
+        if lag is not None and not self.__resyncing and not part:
+            twoot['lag'] = lag
+        log_event(log.DEBUG, 'twoot.stored', 'Storing a twoot: %s', twoot,
+                  **twoot)
         self.twoots.insert(0, twoot)
+        self.__index_twoot(twoot)
+
+    def __measure_lag(self, post, started, media_time, publish_start, r):
+        """Measure the sync lag of forwarding `post` as `r`.
+
+        The lag is the time from the creation of the source post to that of
+        the destination post, which is split into queueing (until the process
+        of the post started), media (downloading and uploading media), and
+        publish (processing text and posting) times.
+
+        Args:
+            post (Post): the source post
+            started (float): when the process of the post started
+            media_time (float): the time taken for media
+            publish_start (float): when the text process started
+            r: the destination post dict
+
+        Returns:
+            dict: total, queue, media, and publish times (seconds)
+        """
+        now = time.time()
+        created = r.get('created_at', None)
+        if isinstance(created, str):
+            created = _parse_twitter_time(created)
+        dest_created = created.timestamp() if created else now
+
+        return {
+            'total': dest_created - post.created_at.timestamp(),
+            'queue': started - post.created_at.timestamp(),
+            'media': media_time,
+            'publish': now - publish_start,
+        }
+
+    def __filter(self, post, direction):
+        """Returns the name of the first filter rule matching `post`.
+
+        Args:
+            post (Post): the post
+            direction (str): 'toots' or 'tweets'
+
+        Returns:
+            str: the name of the rule (None if no rule matches)
+        """
+        # match texts of toots without HTML tags (e.g., hrefs)
+        text = post.text
+        if direction == 'toots' and self.filters:
+            text = self.__html2text(text)
+
+        for rule in self.filters:
+            if rule.matches(post, direction, text):
+                self.filter_hits[rule.name] = \
+                    self.filter_hits.get(rule.name, 0) + 1
+                return rule.name
+
+        return None
 
     def __find_paired_toot(self, tweet_id):
         """Returns the id of paired toot of `tweet_id`.
@@ -370,12 +1976,7 @@ class Twoot:
         Returns:
             int: Id of the paired toot of `tweet_id`
         """
-        for t in self.twoots + self.data['twoots']:
-            if t['tweet_id'] == tweet_id:
-                toot_id = t['toot_id']
-                return toot_id
-
-        return None
+        return self.__toot_of_tweet.get(tweet_id, None)
 
     def __find_paired_tweet(self, toot_id):
         """Returns the id of paired tweet of `toot_id`.
@@ -386,12 +1987,7 @@ class Twoot:
         Returns:
             int: Id of the paired tweet of `toot_id`
         """
-        for t in self.twoots + self.data['twoots']:
-            if t['toot_id'] == toot_id:
-                tweet_id = t['tweet_id']
-                return tweet_id
-
-        return None
+        return self.__tweet_of_toot.get(toot_id, None)
 
     def __html2text(self, html):
         """Convert html to text.
@@ -428,28 +2024,15 @@ class Twoot:
 
         return text
 
-    def __pre_process(self, text, remove_words=[]):
-        """Format a text nicely before posting.
-
-        This function do four things:
-
-            1. convert HTML to plain text
-            2. expand shorten links
-            3. remove given `remove_words` such as links of attached media
-            4. search usernames and escape by adding a dot (.) if any
-            5. delete tailing spaces
+    def __expand_links(self, text):
+        """Expand shorten links in `text` with HTTP(S) HEAD requests.
 
         Args:
             text (str): the text
-            remove_words (str): the list of words to remove
 
         Returns:
-            str: the pre-processed text
+            str: the text with expanded links
         """
-        # process HTML tags/escapes
-        text = self.__html2text(text)
-
-        # expand links
         links = [w for w in text.split() if urlparse(w.strip()).scheme]
 
         for link in links:
@@ -459,22 +2042,157 @@ class Twoot:
 
             # expand link with HTTP(S) HEAD request
             try:
-                r = requests.head(link)
+                r = self.http.head(link)
                 url = r.headers.get('location', link)
                 text = text.replace(link, url)
 
             except Exception as e:
                 logger.exception('HTTP(S) HEAD request failed: {}'.format(e))
 
+        return text
+
+    def __escape_mentions(self, text):
+        """Prevent mentions by inserting a word joiner after each '@'."""
+        return MENTION_RE.sub(
+            lambda m: '@\u2060' + m.group(1) + (m.group(2) or ''), text)
+
+    def __mastodon_account_exists(self, acct):
+        """Returns True if the Mastodon account `acct` (user@host) exists.
+
+        Remote accounts are resolved by the instance (i.e., WebFinger), so
+        that a URL of another service (e.g., https://medium.com/@alice) is
+        never taken for a Mastodon account.
+        """
+        user, host = acct.split('@', 1)
+        names = {acct.lower()}
+        if host.lower() == urlparse(
+                self.config['mastodon']['instance']).netloc.lower():
+            names.add(user.lower())  # local accounts have no host
+
+        r = self.mastodon.account_search(acct, limit=5, resolve=True)
+        return any(a['acct'].lower() in names for a in r)
+
+    def __twitter_account_exists(self, handle):
+        """Returns True if the Twitter account `handle` exists."""
+        try:
+            self.twitter.users.show(screen_name=handle)
+            return True
+
+        # unknown or suspended users
+        except Twitter.TwitterHTTPError as e:
+            if e.e.code in (403, 404):
+                return False
+            raise
+
+    def __lookup_mastodon_account(self, handle):
+        """Find a Mastodon account in the Twitter profile of `handle`."""
+        r = self.twitter.users.show(screen_name=handle)
+        urls = r.get('entities', {}).get('url', {}).get('urls', [])
+        texts = [r.get('description', ''), r.get('name', '')]
+        texts += [u.get('expanded_url', '') or '' for u in urls]
+
+        for m in MASTODON_ACCOUNT_RE.finditer(' '.join(texts)):
+            if m.group(1):
+                acct = '{}@{}'.format(m.group(1), m.group(2))
+            else:
+                acct = '{}@{}'.format(m.group(4), m.group(3))
+            if self.__mastodon_account_exists(acct):
+                return acct
+
+        return None
+
+    def __lookup_twitter_account(self, acct):
+        """Find a Twitter handle in the Mastodon profile of `acct`."""
+        r = self.mastodon.account_lookup(acct)
+        texts = [r.get('note', '')]
+        texts += [f.get('value', '') for f in r.get('fields', [])]
+
+        for m in TWITTER_ACCOUNT_RE.finditer(' '.join(texts)):
+            handle = m.group(1)
+            if handle.lower() not in TWITTER_RESERVED and \
+                    self.__twitter_account_exists(handle):
+                return handle
+
+        return None
+
+    def __map_mentions(self, text, origin, mentions):
+        """Replace mentions with the accounts of the other service.
+
+        Only the accounts actually mentioned in the post are mapped, and the
+        others are escaped as __escape_mentions does.
+
+        Args:
+            text (str): the text
+            origin (str): the source of the text ('toot' or 'tweet')
+            mentions (list): the mentioned Twitter handles or Mastodon accts
+
+        Returns:
+            str: the text with mapped mentions
+        """
+        if origin == 'tweet':
+            service, lookup = 'twitter', self.__lookup_mastodon_account
+            accts = {m.lower(): m for m in mentions}
+        else:
+            # local accounts are mentioned without the host
+            service, lookup = 'mastodon', self.__lookup_twitter_account
+            host = urlparse(self.config['mastodon']['instance']).netloc
+            accts = {}
+            for m in mentions:
+                acct = m if '@' in m else '{}@{}'.format(m, host)
+                accts[m.lower()] = accts[m.split('@')[0].lower()] = acct
+
+        def replace(m):
+            name = m.group(1) + (m.group(2) or '')
+            acct = accts.get(name.lower(), None)
+            mapped = acct and self.mentions.get(service, acct, lookup)
+            if mapped:
+                return '@' + mapped
+            return '@\u2060' + name
+
+        return MENTION_RE.sub(replace, text)
+
+    def __strip_spaces(self, text):
+        """Delete tailing spaces of each line and the text."""
+        return re.sub(r'[ \t]+\n', r'\n', text).strip()
+
+    def __pre_process(self, text, remove_words=[], origin=None, mentions=[]):
+        """Format a text nicely before posting.
+
+        This function do four things:
+
+            1. convert HTML to plain text
+            2. expand shorten links
+            3. remove given `remove_words` such as links of attached media
+            4. map usernames to the other service or escape them if any
+            5. delete tailing spaces
+
+        Args:
+            text (str): the text
+            remove_words (str): the list of words to remove
+            origin (str): the source of the text ('toot' or 'tweet')
+            mentions (list): the mentioned accounts in the source
+
+        Returns:
+            str: the pre-processed text
+        """
+        # process HTML tags/escapes
+        text = self.__html2text(text)
+
+        # expand links
+        text = self.__expand_links(text)
+
         # remove specified words
         for w in remove_words:
             text = text.replace(w, '')
 
-        # prevent mentions
-        text = re.sub(r'([\s\n(]@)([_\w\d])', r'\1⁠\2', text)
+        # map or prevent mentions
+        if self.mentions is not None and origin is not None:
+            text = self.__map_mentions(text, origin, mentions)
+        else:
+            text = self.__escape_mentions(text)
 
         # no tailing spaces
-        text = re.sub(r'[ \t]+\n', r'\n', text).strip()
+        text = self.__strip_spaces(text)
 
         return text
 
@@ -527,7 +2245,12 @@ class Twoot:
             raw binary data
             str: content type
         """
-        r = requests.get(url)
+        try:
+            r = self.http.get(url)
+        except (CircuitOpenError, requests.exceptions.RequestException) as e:
+            logger.warn('Failed to get an image from {}: {}'.format(url, e))
+            return None
+
         if r.status_code != 200:
             logger.warn('Failed to get an image from {}'.format(url))
             return None
@@ -549,68 +2272,113 @@ class Twoot:
             raw binary data
             str: content type
         """
-        r = requests.get(url)
+        try:
+            r = self.http.get(url)
+        except (CircuitOpenError, requests.exceptions.RequestException) as e:
+            logger.warn('Failed to get a video from {}: {}'.format(url, e))
+            return None
+
         if r.status_code != 200:
             logger.warn('Failed to get a video from {}'.format(url))
             return None
 
-        c_type = r.headers['content-type']
-        if 'video' not in c_type:
-            logger.warn('Data from {} is not a video'.format(url))
-            return None
+        c_type = r.headers['content-type']
+        if 'video' not in c_type:
+            logger.warn('Data from {} is not a video'.format(url))
+            return None
+
+        return r.content, c_type
+
+    def __transformed_media(self, fetched):
+        """Wait for the transform of fetched media.
+
+        If the transform failed, the original data is used instead.
+
+        Args:
+            fetched (tuple): media type, data, content type and the future
+
+        Returns:
+            str: media type
+            raw binary data
+            str: content type
+        """
+        media_type, data, mime_type, future = fetched
+
+        try:
+            data, mime_type = future.result()
+        except Exception as e:
+            logger.warn(
+                'Failed to transform media; use the original: {}'.format(e))
 
-        return r.content, c_type
+        return media_type, data, mime_type
 
-    def __post_media_to_mastodon(self, media):
-        """Get actual data of `media` from Twitter and post it to Mastodon.
+    def __fetch_media_for_mastodon(self, media):
+        """Get actual data of `media` from Twitter and queue its transform.
 
         Args:
-            media: a Twitter media dict
+            media (MediaInfo): a Twitter media
 
         Returns:
-            a Mastodon media dict
+            tuple: media type, data, content type and the transform future
         """
-        media_type = media['type']
+        media_type = media.type
 
-        if media_type == 'photo':
-            img, mime_type = self.__download_image(media['media_url_https'])
+        if media_type == 'image':
+            res = self.__download_image(media.url)
+        elif media_type == 'gifv':
+            res = self.__download_video(media.url)
+        else:
+            logger.warn('Unknown media type found. Skipping.')
+            return None
 
-            try:
-                r = self.mastodon.media_post(img, mime_type=mime_type)
+        if res is None:
+            return None
 
-                logger.debug('Recieved media info: {}'.format(str(r)))
+        data, mime_type = res
+        future = self.media_transformer.submit(data, mime_type, 'mastodon')
 
-                return r
+        return media_type, data, mime_type, future
 
-            # if failed, report it
-            except Exception as e:
-                logger.exception('Failed to post an image: {}'.format(e))
-                return None
+    def __post_media_to_mastodon(self, fetched, synchronous=False):
+        """Post media fetched from Twitter to Mastodon.
 
-        elif media_type == 'animated_gif':
-            video_url = media['video_info']['variants'][0]['url']
-            video, mime_type = self.__download_video(video_url)
+        Args:
+            fetched (tuple): the result of __fetch_media_for_mastodon
+            synchronous (bool): wait until Mastodon has processed the media
 
-            try:
-                r = self.mastodon.media_post(video, mime_type=mime_type)
-                logger.debug('Recieved media info: {}'.format(str(r)))
-                return r
+        Returns:
+            a Mastodon media dict
+        """
+        media_type, data, mime_type = self.__transformed_media(fetched)
+        kind = 'an image' if media_type == 'image' else 'a video'
 
-            # if failed, report it
-            except Exception as e:
-                logger.exception('Failed to post a video: {}'.format(e))
-                return None
+        try:
+            if synchronous:
+                r = self.mastodon.media_post(data,
+                                             mime_type=mime_type,
+                                             synchronous=True)
+            else:
+                r = self.mastodon.media_post(data, mime_type=mime_type)
+            log_event(log.DEBUG, 'mastodon.media_posted',
+                      'Recieved media info: %s', r, response=r)
+            return r
 
-        else:
-            logger.warn('Unknown media type found. Skipping.')
+        # if failed, report it
+        except Exception as e:
+            logger.exception('Failed to post {}: {}'.format(kind, e))
+            return None
 
     def __toot(self, text, in_reply_to_id=None, media_ids=None):
+        if not self.__is_leader():
+            return None
+
         try:
             r = self.mastodon.status_post(text,
                                           in_reply_to_id=in_reply_to_id,
                                           media_ids=media_ids)
 
-            logger.debug('Recieved toot info: {}'.format(str(r)))
+            log_event(log.DEBUG, 'toot.posted', 'Recieved toot info: %s', r,
+                      response=r)
 
             return r
 
@@ -620,9 +2388,13 @@ class Twoot:
             return None
 
     def __boost(self, target_id):
+        if not self.__is_leader():
+            return None
+
         try:
             r = self.mastodon.status_reblog(target_id)
-            logger.debug('Recieved toot (BT) info: {}'.format(str(r)))
+            log_event(log.DEBUG, 'toot.boosted',
+                      'Recieved toot (BT) info: %s', r, response=r)
             return r
 
         # if failed, report it
@@ -630,6 +2402,244 @@ class Twoot:
             logger.exception('Failed to create a toot (BT): {}'.format(e))
             return None
 
+    def __mastodon_limits(self):
+        """Get the limits of posts of the Mastodon instance.
+
+        The limits are fetched once and cached in the data file for
+        `limits_ttl` seconds.
+        """
+        ttl = self.validation.get('limits_ttl', 86400)
+        cached = self.data.get('mastodon_limits', None)
+        if cached is not None and cached['fetched'] + ttl > time.time():
+            return cached['limits']
+
+        try:
+            r = self.mastodon.instance()
+        except Exception as e:
+            logger.warn('Failed to get the instance limits: {}'.format(e))
+            return MASTODON_LIMITS
+
+        statuses = r.get('configuration', {}).get('statuses', {})
+        limits = {
+            'max_chars':
+            statuses.get('max_characters',
+                         r.get('max_toot_chars',
+                               MASTODON_LIMITS['max_chars'])),
+            'url_length':
+            statuses.get('characters_reserved_per_url',
+                         MASTODON_LIMITS['url_length']),
+            'max_media':
+            statuses.get('max_media_attachments',
+                         MASTODON_LIMITS['max_media']),
+        }
+        logger.debug('Limits of the instance: {}'.format(limits))
+
+        self.data['mastodon_limits'] = {
+            'limits': limits,
+            'fetched': time.time()
+        }
+        self.__update_last_id('mastodon_limits', self.data['mastodon_limits'])
+
+        return limits
+
+    def __validate(self, service, post, text, media):
+        """Plan the posts of `post` within the limits of `service`.
+
+        Args:
+            service (str): the destination ('twitter' or 'mastodon')
+            post (Post): the source post
+            text (str): the pre-processed text
+            media (list): MediaInfo of attachments
+
+        Returns:
+            list: the posts (pairs of a text and media) of a thread, or None
+        """
+        if self.validation is None:
+            return [(text, media)]
+
+        # the limits of Mastodon are fetched only when needed
+        if service not in self.__validators:
+            self.__validators[service] = PostValidator(
+                service, self.__mastodon_limits(),
+                self.validation.get('policy', 'truncate'))
+
+        return self.__validators[service].plan(text, media, post.url)
+
+    def __continue_thread(self, service, parts, source_id, in_reply_to_id,
+                          dry_run):
+        """Post the rest of a split post as replies to `in_reply_to_id`.
+
+        The parts are stored as twoots with the source post, so that they are
+        never forwarded back as self replies (and deleted with the source).
+
+        Args:
+            service (str): the destination ('twitter' or 'mastodon')
+            parts (list): pairs of a text and media
+            source_id (int): Id of the source post
+            in_reply_to_id (int): Id of the first post
+            dry_run (bool): the flag
+        """
+        for text, media in parts:
+            logger.debug('Trying to continue the thread: {} (with {} media)'.
+                         format(repr(text), len(media)))
+            if dry_run:
+                continue
+
+            if service == 'mastodon':
+                fetched = [self.__fetch_media_for_mastodon(m) for m in media]
+                posted = [
+                    self.__post_media_to_mastodon(f) for f in fetched
+                    if f is not None
+                ]
+                media_ids = [m['id'] for m in posted if m is not None]
+                r = self.__toot(text,
+                                in_reply_to_id=in_reply_to_id,
+                                media_ids=media_ids)
+            else:
+                fetched = [self.__fetch_media_for_twitter(m) for m in media]
+                posted = [
+                    self.__post_media_to_twitter(f) for f in fetched
+                    if f is not None
+                ]
+                media_ids = [
+                    m['media_id_string'] for m in posted if m is not None
+                ]
+                r = self.__tweet(text,
+                                 in_reply_to_id=in_reply_to_id,
+                                 media_ids=media_ids)
+
+            if not r:
+                logger.warn('Failed to continue the thread of {} (id: {})'.
+                            format(service, in_reply_to_id))
+                return
+            in_reply_to_id = r['id']
+
+            if service == 'mastodon':
+                self.__store_twoot(r['id'], source_id, 'tweet', part=True)
+            else:
+                self.__store_twoot(source_id, r['id'], 'toot', part=True)
+
+    def __can_defer_media(self, media, text):
+        """Returns True if `media` can be attached after tooting `text`.
+
+        The media are attached by editing the toot, which needs Mastodon
+        3.5.0 or later. Toots must have some text without media.
+        """
+        if 'deferred_media' not in self.config or not media:
+            return False
+
+        # editing is supported since Mastodon.py 1.8
+        if not hasattr(Mastodon, 'status_update'):
+            logger.warn('Mastodon.py is too old to attach media afterwards')
+            return False
+
+        if not text.strip():
+            return False
+
+        try:
+            return self.mastodon.verify_minimum_version('3.5.0', cached=True)
+        except Exception as e:
+            logger.warn('Failed to get the Mastodon version: {}'.format(e))
+            return False
+
+    def __defer_media(self, toot_id, text, media):
+        """Queue media to be attached to the toot `toot_id` afterwards.
+
+        The queue is saved in the data file at once, so that the media are
+        attached in the next run even if this run is terminated.
+        """
+        self.deferred_media.append({
+            'toot_id': toot_id,
+            'text': text,
+            'media': [(m.type, m.url, m.expanded_url) for m in media],
+            'runs': 0
+        })
+        self.__update_last_id('deferred_media', self.deferred_media)
+
+    def __attach_deferred_media(self):
+        """Attach media to the toots published ahead of them.
+
+        Failed downloads and uploads are retried up to `retries` times with
+        exponential backoff, and then the toot is edited once with all the
+        media. If some media still fail, the toot is left in the queue for the
+        next run; in the last of `max_runs` runs, it is edited with the rest.
+        """
+        conf = self.config['deferred_media']
+        retries = conf.get('retries', 3)
+        backoff = conf.get('backoff', 5)
+        max_runs = conf.get('max_runs', 5)
+
+        for entry in list(self.deferred_media):
+            toot_id, text = entry['toot_id'], entry['text']
+            media = [MediaInfo(*m) for m in entry['media']]
+            media_ids = [None] * len(media)
+
+            for attempt in range(retries + 1):
+                if attempt > 0:
+                    time.sleep(backoff * 2**(attempt - 1))
+                    logger.info('Retrying {} media of a toot (id: {})'.format(
+                        media_ids.count(None), toot_id))
+
+                # the lease may be lost while backing off
+                if not self.__is_leader():
+                    return
+
+                for i, m in enumerate(media):
+                    if media_ids[i] is not None:
+                        continue
+
+                    f = self.__fetch_media_for_mastodon(m)
+                    if f is not None:
+                        r = self.__post_media_to_mastodon(f, synchronous=True)
+                        if r is not None:
+                            media_ids[i] = r['id']
+
+                if None not in media_ids:
+                    break
+
+            # edit the toot with all the media (or the rest at last)
+            entry['runs'] += 1
+            last = entry['runs'] >= max_runs
+            ids = [i for i in media_ids if i is not None]
+            attached = False
+            if ids and (len(ids) == len(media) or last):
+                for attempt in range(retries + 1):
+                    if attempt > 0:
+                        time.sleep(backoff * 2**(attempt - 1))
+
+                    if not self.__is_leader():
+                        return
+
+                    try:
+                        r = self.mastodon.status_update(toot_id,
+                                                        text,
+                                                        media_ids=ids)
+                        log_event(log.DEBUG, 'toot.edited',
+                                  'Recieved toot info: %s', r, response=r)
+                        logger.info(
+                            'Attached {} of {} media to a toot (id: {})'.
+                            format(len(ids), len(media), toot_id))
+                        attached = True
+                        break
+
+                    # if failed, report it
+                    except Exception as e:
+                        logger.exception(
+                            'Failed to attach media to a toot (id: {}): {}'.
+                            format(toot_id, e))
+
+            if attached:
+                self.deferred_media.remove(entry)
+            elif last:
+                logger.warn('Giving up attaching media to a toot (id: {})'.
+                            format(toot_id))
+                self.deferred_media.remove(entry)
+            else:
+                logger.warn('Failed to attach media to a toot (id: {}); '
+                            'retrying in the next run'.format(toot_id))
+
+            self.__update_last_id('deferred_media', self.deferred_media)
+
     def create_toot_from_tweet(self, tweet, dry_run=False):
         """Create a toot corresponding to the tweet.
 
@@ -643,14 +2653,13 @@ class Twoot:
         the actual post will never executed but only the messages are output.
 
         Args:
-            tweet: a tweet dict
+            tweet (Post): a tweet post
             dry_run (bool): the flag
         """
         my_id = self.data['twitter_account']['id']
-        tweet_id = tweet['id']
-        synced_tweets = [
-            t['tweet_id'] for t in self.twoots + self.data['twoots']
-        ]
+        tweet_id = tweet.id
+        synced_tweets = self.__toot_of_tweet
+        started = time.time()
 
         def debug_skip(tw_id, reason):
             logger.debug('Skipping a tweet (id: {}) because {}'.format(
@@ -661,10 +2670,16 @@ class Twoot:
             debug_skip(tweet_id, 'it is already forwarded')
             return
 
+        # skip if filtered out; before any media or link work
+        rule = self.__filter(tweet, 'tweets')
+        if rule is not None:
+            debug_skip(tweet_id, 'it matches filter {}'.format(rule))
+            return
+
         # reply case; a bit complecated
         in_reply_to_tweet_id = None
-        in_reply_to_user_id = tweet.get('in_reply_to_user_id', None)
-        user_mentions = tweet.get('entities', {}).get('user_mentions', [])
+        in_reply_to_user_id = tweet.in_reply_to_account_id
+        user_mentions = tweet.mentions
 
         if in_reply_to_user_id:
             # skip reply for other users
@@ -673,20 +2688,18 @@ class Twoot:
                 return
 
             # reply to multiple users including oneself
-            if re.match(r'@[_\w\d]', tweet['full_text']):
+            if re.match(r'@[_\w\d]', tweet.text):
                 debug_skip(tweet_id, 'it is a self reply but also to others')
                 return
 
             # if self reply, store in_reply_to_tweet_id for creating a thread
             logger.debug('The tweet (id: {}) is a self reply'.format(tweet_id))
-            in_reply_to_tweet_id = tweet['in_reply_to_status_id']
+            in_reply_to_tweet_id = tweet.in_reply_to_id
 
         # RT case; more complecated
-        retweeted_tweet = tweet.get('retweeted_status', None)
-
-        if retweeted_tweet:
-            retweeted_tweet_id = retweeted_tweet['id']
+        retweeted_tweet_id = tweet.reblog_id
 
+        if retweeted_tweet_id:
             # if self RT of a synced tweet, exec BT on the paired toot
             if retweeted_tweet_id in synced_tweets:
                 target_toot_id = self.__find_paired_toot(retweeted_tweet_id)
@@ -698,7 +2711,8 @@ class Twoot:
 
                     if r:
                         toot_id = r['id']
-                        self.__store_twoot(toot_id, tweet_id)
+                        lag = self.__measure_lag(tweet, started, 0, started, r)
+                        self.__store_twoot(toot_id, tweet_id, 'tweet', lag)
 
                 # no more process for RT
                 return
@@ -708,27 +2722,54 @@ class Twoot:
                 debug_skip(tweet_id, 'it is an RT')
                 return
 
+        # treat text first to validate the toot before any upload
+        twitter_media = tweet.media
+        text_start = time.time()
+        media_urls = [m.expanded_url for m in twitter_media]
+        text = self.__pre_process(tweet.text,
+                                  remove_words=media_urls,
+                                  origin='tweet',
+                                  mentions=tweet.mentions)
+        text = self.__replace_rt_cite(text, tweet.id)
+        parts = self.__validate('mastodon', tweet, text, twitter_media)
+        text_time = time.time() - text_start
+
+        if parts is None:
+            logger.warn('Skipping a tweet (id: {}) exceeding the limits of '
+                        'Mastodon'.format(tweet_id))
+            return
+
+        # see if media can be deferred
+        text, twitter_media = parts[0]
+        deferred = not dry_run and len(parts) == 1 and \
+            self.__can_defer_media(twitter_media, text)
+
         # treat media
-        twitter_media = tweet.get('extended_entities', {}).get('media', [])
         media_num = 0
+        media_start = time.time()
 
         # if dry run, don't upload
         if dry_run:
             media_num = len(twitter_media)
 
+        # publish the text now and attach media later
+        elif deferred:
+            media_ids = None
+
         else:
+            # download all first; transforms run during the downloads
+            fetched = [
+                self.__fetch_media_for_mastodon(m) for m in twitter_media
+            ]
             mastodon_media = [
-                self.__post_media_to_mastodon(m) for m in twitter_media
+                self.__post_media_to_mastodon(f) for f in fetched
+                if f is not None
             ]
             media_ids = [m['id'] for m in mastodon_media if m is not None]
             media_num = len(media_ids)
 
-        # treat text
-        media_urls = [m['expanded_url'] for m in twitter_media]
-        text = self.__pre_process(tweet['full_text'], remove_words=media_urls)
-        text = self.__replace_rt_cite(text, tweet['id'])
-
         # try to create a toot
+        publish_start = time.time()
         if media_num > 0:
             logger.debug('Trying to toot: {} (with {} media)'.format(
                 repr(text), media_num))
@@ -751,29 +2792,69 @@ class Twoot:
             # store the twoot
             if r:
                 toot_id = r['id']
-                self.__store_twoot(toot_id, tweet_id)
+                lag = self.__measure_lag(tweet, started,
+                                         publish_start - media_start,
+                                         publish_start - text_time, r)
+                self.__store_twoot(toot_id, tweet_id, 'tweet', lag)
 
                 logger.info(
                     'Forwarded a tweet (id: {}) as a toot (id: {})'.format(
                         tweet_id, toot_id))
+                self.__continue_thread('mastodon', parts[1:], tweet_id,
+                                       toot_id, dry_run)
+
+                if deferred:
+                    self.__defer_media(toot_id, text, twitter_media)
+
+        elif len(parts) > 1:
+            self.__continue_thread('mastodon', parts[1:], tweet_id, None,
+                                   dry_run)
+
+    def __fetch_media_for_twitter(self, media):
+        """Get actual data of `media` from Mastodon and queue its transform.
+
+        Args:
+            media (MediaInfo): a Mastodon media
+
+        Returns:
+            tuple: media type, data, content type and the transform future
+        """
+        media_type = media.type
+
+        if media_type == 'image':
+            res = self.__download_image(media.url)
+        elif media_type == 'gifv':
+            res = self.__download_video(media.url)
+        else:
+            logger.warn('Unknown media type found. Skipping.')
+            return None
+
+        if res is None:
+            return None
+
+        data, mime_type = res
+        future = self.media_transformer.submit(data, mime_type, 'twitter')
+
+        return media_type, data, mime_type, future
 
-    def __post_media_to_twitter(self, media):
-        """Get actual data of `media` from Mastodon and post it to Twitter.
+    def __post_media_to_twitter(self, fetched):
+        """Post media fetched from Mastodon to Twitter.
 
         Args:
-            media: a Mastodon media dict
+            fetched (tuple): the result of __fetch_media_for_twitter
 
         Returns:
             a Twitter media dict
         """
-        media_type = media['type']
+        media_type, data, mime_type = self.__transformed_media(fetched)
 
         if media_type == 'image':
-            img, mime_type = self.__download_image(media['url'])
+            img = data
 
             try:
                 r = self.twitter_upload.media.upload(media=img)
-                logger.debug('Recieved media info: {}'.format(str(r)))
+                log_event(log.DEBUG, 'twitter.media_posted',
+                          'Recieved media info: %s', r, response=r)
                 return r
 
             # if failed, report it
@@ -781,8 +2862,8 @@ class Twoot:
                 logger.exception('Failed to post an image: {}'.format(e))
                 return None
 
-        elif media_type == 'gifv':
-            video, mime_type = self.__download_video(media['url'])
+        else:
+            video = data
 
             try:
                 # init
@@ -809,10 +2890,10 @@ class Twoot:
                 logger.exception('Failed to post an image: {}'.format(e))
                 return None
 
-        else:
-            logger.warn('Unknown media type found. Skipping.')
-
     def __tweet(self, text, in_reply_to_id=None, media_ids=None):
+        if not self.__is_leader():
+            return None
+
         try:
             r = self.twitter.statuses.update(
                 status=text,
@@ -820,7 +2901,8 @@ class Twoot:
                 media_ids=','.join(media_ids))
 
             # NOTE: only under development
-            logger.debug('Recieved tweet info: {}'.format(str(r)))
+            log_event(log.DEBUG, 'tweet.posted', 'Recieved tweet info: %s', r,
+                      response=r)
 
             return r
 
@@ -830,9 +2912,13 @@ class Twoot:
             return None
 
     def __retweet(self, target_id):
+        if not self.__is_leader():
+            return None
+
         try:
             r = self.twitter.statuses.retweet(_id=target_id)
-            logger.debug('Recieved toot (BT) info: {}'.format(str(r)))
+            log_event(log.DEBUG, 'tweet.retweeted',
+                      'Recieved tweet (RT) info: %s', r, response=r)
             return r
 
         # if failed, report it
@@ -853,14 +2939,13 @@ class Twoot:
         the actual post will never executed but only the messages are output.
 
         Args:
-            toot: a toot dict
+            toot (Post): a toot post
             dry_run (bool): the flag
         """
         my_id = self.data['mastodon_account']['id']
-        toot_id = toot['id']
-        synced_toots = [
-            t['toot_id'] for t in self.twoots + self.data['twoots']
-        ]
+        toot_id = toot.id
+        synced_toots = self.__tweet_of_toot
+        started = time.time()
 
         def debug_skip(tt_id, reason):
             logger.debug('Skipping a toot (id: {}) because {}'.format(
@@ -871,9 +2956,15 @@ class Twoot:
             debug_skip(toot_id, 'it is already forwarded')
             return
 
+        # skip if filtered out; before any media or link work
+        rule = self.__filter(toot, 'toots')
+        if rule is not None:
+            debug_skip(toot_id, 'it matches filter {}'.format(rule))
+            return
+
         # reply case; a bit complecated
         in_reply_to_toot_id = None
-        in_reply_to_account_id = toot['in_reply_to_account_id']
+        in_reply_to_account_id = toot.in_reply_to_account_id
 
         if in_reply_to_account_id:
             # skip reply for other users
@@ -883,14 +2974,12 @@ class Twoot:
 
             # if self reply, store in_reply_to_toot_id for creating a thread
             logger.debug('The toot (id: {}) is a self reply'.format(toot_id))
-            in_reply_to_toot_id = toot['in_reply_to_id']
+            in_reply_to_toot_id = toot.in_reply_to_id
 
         # BT case; more complecated
-        boosted_toot = toot.get('reblog', None)
-
-        if boosted_toot:
-            boosted_toot_id = boosted_toot['id']
+        boosted_toot_id = toot.reblog_id
 
+        if boosted_toot_id:
             # if self BT of a synced toot, exec RT on the paired tweet
             if boosted_toot_id in synced_toots:
                 target_tweet_id = self.__find_paired_tweet(boosted_toot_id)
@@ -903,7 +2992,8 @@ class Twoot:
 
                     if r:
                         tweet_id = r['id']
-                        self.__store_twoot(toot_id, tweet_id)
+                        lag = self.__measure_lag(toot, started, 0, started, r)
+                        self.__store_twoot(toot_id, tweet_id, 'toot', lag)
 
                 # no more process for BT
                 return
@@ -913,27 +3003,44 @@ class Twoot:
                 debug_skip(toot_id, 'because it is a BT')
                 return
 
+        # treat text first to validate the tweet before any upload
+        text_start = time.time()
+        text = self.__pre_process(toot.text,
+                                  origin='toot',
+                                  mentions=toot.mentions)
+        parts = self.__validate('twitter', toot, text, toot.media)
+        text_time = time.time() - text_start
+
+        if parts is None:
+            logger.warn('Skipping a toot (id: {}) exceeding the limits of '
+                        'Twitter'.format(toot_id))
+            return
+
         # treat media
-        mastodon_media = toot.get('media_attachments', [])
+        text, mastodon_media = parts[0]
         media_num = 0
+        media_start = time.time()
 
         # if dry run, don't upload
         if dry_run:
             media_num = len(mastodon_media)
 
         else:
+            # download all first; transforms run during the downloads
+            fetched = [
+                self.__fetch_media_for_twitter(m) for m in mastodon_media
+            ]
             twitter_media = [
-                self.__post_media_to_twitter(m) for m in mastodon_media
+                self.__post_media_to_twitter(f) for f in fetched
+                if f is not None
             ]
             media_ids = [
                 m['media_id_string'] for m in twitter_media if m is not None
             ]
             media_num = len(media_ids)
 
-        # treat text
-        text = self.__pre_process(toot['content'])
-
         # try to create a tweet
+        publish_start = time.time()
         if media_num > 0:
             logger.debug('Trying to tweet: {} (with {} media)'.format(
                 repr(text), media_num))
@@ -956,27 +3063,298 @@ class Twoot:
             # store the twoot
             if r:
                 tweet_id = r['id']
-                self.__store_twoot(toot_id, tweet_id)
+                lag = self.__measure_lag(toot, started,
+                                         publish_start - media_start,
+                                         publish_start - text_time, r)
+                self.__store_twoot(toot_id, tweet_id, 'toot', lag)
 
                 logger.info(
                     'Forwarded a toot (id: {}) as a tweet (id: {})'.format(
                         toot_id, tweet_id))
+                self.__continue_thread('twitter', parts[1:], toot_id,
+                                       tweet_id, dry_run)
+
+        elif len(parts) > 1:
+            self.__continue_thread('twitter', parts[1:], toot_id, None,
+                                   dry_run)
 
-    def tweets2toots(self, tweets, dry_run=False):
-        # process from the oldest one
-        for t in reversed(tweets):
-            logger.debug('Processing tweet info: {}'.format(t))
+    def tweets2toots(self, tweets, dry_run=False, update=False):
+        # tweets are already ordered from the oldest one
+        for t in tweets:
+            if not self.__is_leader():
+                break
+
+            log_event(log.DEBUG, 'tweet.processing',
+                      'Processing tweet info: %s', t, tweet=t)
 
             # create a toot if necessary
             self.create_toot_from_tweet(t, dry_run)
+            self.__after_forward(dry_run, update, 'last_tweet', t.id)
+
+        # attach media after all the texts are published
+        if self.deferred_media and not dry_run and self.__is_leader():
+            self.__attach_deferred_media()
 
-    def toots2tweets(self, toots, dry_run=False):
-        # process from the oldest one
-        for t in reversed(toots):
-            logger.debug('Processing toot info: {}'.format(t))
+    def toots2tweets(self, toots, dry_run=False, update=False):
+        # toots are already ordered from the oldest one
+        for t in toots:
+            if not self.__is_leader():
+                break
+
+            log_event(log.DEBUG, 'toot.processing',
+                      'Processing toot info: %s', t, toot=t)
 
             # create a toot if necessary
             self.create_tweet_from_toot(t, dry_run)
+            self.__after_forward(dry_run, update, 'last_toot', t.id)
+
+    def __fetch_source_page(self, origin, max_id, count):
+        """Fetch a page of the author's posts older than `max_id`.
+
+        Args:
+            origin (str): 'toot' or 'tweet'
+            max_id (int): the exclusive upper bound (None for the latest)
+            count (int): the number of posts
+
+        Returns:
+            list: Ids of the posts (the latest first)
+        """
+        if origin == 'toot':
+            my_id = self.data['mastodon_account']['id']
+            r = self.mastodon.account_statuses(my_id,
+                                               max_id=max_id,
+                                               limit=count)
+        else:
+            my_id = self.data['twitter_account']['id']
+            kwargs = {'user_id': my_id, 'count': count, 'trim_user': True}
+            if max_id:
+                kwargs['max_id'] = max_id - 1  # inclusive in Twitter
+            r = self.twitter.statuses.user_timeline(**kwargs)
+
+        return [p['id'] for p in r]
+
+    def __fetch_range(self, origin, since_id, max_id):
+        """Fetch all the author's posts in the id range.
+
+        Args:
+            origin (str): 'toot' or 'tweet'
+            since_id (int): the exclusive lower bound
+            max_id (int): the exclusive upper bound
+
+        Returns:
+            list: posts (the latest first)
+        """
+        posts = []
+
+        while True:
+            if origin == 'toot':
+                r = self.mastodon.account_statuses(
+                    self.data['mastodon_account']['id'],
+                    since_id=since_id,
+                    max_id=max_id,
+                    limit=40)
+                page = [Post.from_toot(t) for t in r]
+            else:
+                r = self.twitter.statuses.user_timeline(
+                    user_id=self.data['twitter_account']['id'],
+                    since_id=since_id,
+                    max_id=max_id - 1,  # inclusive in Twitter
+                    count=200,
+                    tweet_mode="extended")
+                page = [Post.from_tweet(t) for t in r]
+            del r
+
+            page = [p for p in page if since_id < p.id < max_id]
+            if len(page) == 0:
+                return posts
+
+            posts += page
+            max_id = min(p.id for p in page)
+
+    def resync(self, since, until=None, ranges=4, dry_run=False,
+               update=False):
+        """Forward the unsynced posts created in the time window.
+
+        The window is split into `ranges` id ranges of both services, which
+        are fetched in parallel. Then the posts not in the stored twoots are
+        forwarded from the oldest one (of both services), so that threads and
+        self retweets (boosts) are resolved as usual. The window is limited
+        to the stored twoots when they are full, since the posts forwarded
+        before them cannot be told from the others.
+
+        Args:
+            since (float): the start of the window (epoch)
+            until (float): the end of the window (epoch), None for now
+            ranges (int): the number of ranges
+            dry_run (bool): the flag
+            update (bool): the flag
+        """
+        open_ended = until is None
+        until = until or time.time()
+
+        # never go beyond the stored twoots
+        twoots = self.data['twoots']
+        if len(twoots) >= self.config['max_twoots']:
+            oldest = _mastodon_id_time(twoots[-1]['toot_id'])
+            if since < oldest:
+                logger.warn(
+                    'Limiting the window to the stored twoots (since {})'.
+                    format(datetime.fromtimestamp(oldest, timezone.utc)))
+                since = oldest
+                if since >= until:
+                    return
+
+        # split the window and fetch the ranges in parallel
+        step = (until - since) / ranges
+        bounds = [since + step * i for i in range(ranges)] + [until]
+        id_at = {'toot': _mastodon_id_at, 'tweet': _twitter_id_at}
+
+        fetched = {'toot': [], 'tweet': []}
+        with ThreadPoolExecutor(max_workers=ranges * 2) as executor:
+            futures = [(origin,
+                        executor.submit(self.__fetch_range, origin,
+                                        id_at[origin](lo) - 1,
+                                        id_at[origin](hi)))
+                       for origin in ('toot', 'tweet')
+                       for lo, hi in zip(bounds, bounds[1:])]
+
+            for origin, f in futures:
+                try:
+                    fetched[origin] += f.result()
+                except Exception as e:
+                    logger.exception('Failed to fetch {}s: {}'.format(
+                        origin, e))
+                    return
+
+        # diff against the stored twoots
+        synced = {'toot': self.__tweet_of_toot, 'tweet': self.__toot_of_tweet}
+        unsynced = [(p, origin) for origin in ('toot', 'tweet')
+                    for p in fetched[origin] if p.id not in synced[origin]]
+        logger.info('Found {} unsynced of {} toots and {} tweets'.format(
+            len(unsynced), len(fetched['toot']), len(fetched['tweet'])))
+
+        # forward them from the oldest one; their lags are meaningless
+        unsynced.sort(key=lambda x: (x[0].created_at.timestamp(), x[0].id))
+        self.__resyncing = True
+        for p, origin in unsynced:
+            if not self.__is_leader():
+                break
+
+            log_event(log.DEBUG, origin + '.processing',
+                      'Processing ' + origin + ' info: %s', p, **{origin: p})
+            if origin == 'toot':
+                self.create_tweet_from_toot(p, dry_run)
+            else:
+                self.create_toot_from_tweet(p, dry_run)
+            self.__after_forward(dry_run)
+        self.__resyncing = False
+
+        if self.deferred_media and not dry_run and self.__is_leader():
+            self.__attach_deferred_media()
+
+        # reset the (maybe corrupted) last ids to the latest
+        if open_ended and (not dry_run or update):
+            for origin in ('toot', 'tweet'):
+                if fetched[origin]:
+                    last_id = max(p.id for p in fetched[origin])
+                    logger.debug('Updating the last {}: {}'.format(
+                        origin, last_id))
+                    self.__update_last_id('last_' + origin, last_id)
+
+    def __delete_paired_post(self, twoot):
+        """Delete the post paired with the source post of `twoot`.
+
+        Returns:
+            bool: True if deleted
+        """
+        if not self.__is_leader():
+            return False
+
+        try:
+            if twoot['origin'] == 'toot':
+                self.twitter.statuses.destroy(_id=twoot['tweet_id'])
+            else:
+                self.mastodon.status_delete(twoot['toot_id'])
+            return True
+
+        # if failed, report it
+        except Exception as e:
+            logger.exception('Failed to delete the paired post of {}: '
+                             '{}'.format(twoot, e))
+            return False
+
+    def __sync_deletions_of(self, origin, dry_run=False, update=False):
+        """Propagate deletions of the author's posts on the `origin` side.
+
+        Only a window of the latest `window` twoots from the origin is
+        reconciled, and only a page of `page_size` source posts is fetched in
+        each run. The page to fetch next is persisted as a checkpoint in the
+        data; it goes back to the latest once the window is covered.
+
+        Args:
+            origin (str): 'toot' or 'tweet'
+            dry_run (bool): the flag
+            update (bool): the flag
+        """
+        conf = self.config['delete_sync']
+        window, page_size = conf.get('window', 200), conf.get('page_size', 40)
+        src_key = origin + '_id'
+
+        # the window of twoots from the origin (the latest first)
+        twoots = [
+            t for t in self.data['twoots'] if t.get('origin', None) == origin
+        ][:window]
+        if len(twoots) < 1:
+            return
+
+        # fetch a page of the source posts
+        checkpoints = self.data.get('delete_checkpoints', {})
+        max_id = checkpoints.get(origin, None)
+
+        try:
+            page = self.__fetch_source_page(origin, max_id, page_size)
+        except Exception as e:
+            logger.exception('Failed to get {}s for deletion sync: '
+                             '{}'.format(origin, e))
+            return
+
+        # an empty page is never trusted; just restart from the latest
+        if len(page) > 0:
+            # no upper bound for the page from the latest
+            existing = set(page)
+            upper = max_id if max_id is not None else float('inf')
+            lower = page[-1]
+
+            for t in twoots:
+                src_id = t[src_key]
+                if lower <= src_id < upper and src_id not in existing:
+                    logger.info(
+                        'Deleting the paired post of a deleted {} (id: {}) '
+                        '{}'.format(origin, src_id, t))
+                    if dry_run or not self.__delete_paired_post(t):
+                        continue
+
+                    self.deleted_twoots.append(t)
+                    self.__toot_of_tweet.pop(t['tweet_id'], None)
+                    self.__tweet_of_toot.pop(t['toot_id'], None)
+
+        # the next checkpoint
+        if len(page) < 1 or page[-1] <= twoots[-1][src_key]:
+            next_id = None
+        else:
+            next_id = page[-1]
+
+        logger.debug('Deletion sync checkpoint for {}s: {}'.format(
+            origin, next_id))
+        checkpoints[origin] = next_id
+        self.data['delete_checkpoints'] = checkpoints
+        if not dry_run or update:
+            self.__update_last_id('delete_checkpoints', checkpoints)
+
+    def sync_deletions(self, dry_run=False, update=False):
+        """Propagate deletions of the author's posts to the paired posts."""
+        for origin in ('toot', 'tweet'):
+            self.__sync_deletions_of(origin, dry_run, update)
 
     def __save_data(self):
         """Save up-to-dated data (twoots) to the data file."""
@@ -984,17 +3362,66 @@ class Twoot:
         with open(self.data_file, 'rb') as f:
             data = pickle.load(f)
 
-        # concat the new twoots to data
-        data['twoots'] = self.twoots + data['twoots']
+        # concat the new (unsaved) twoots to data
+        unsaved = self.twoots[:len(self.twoots) - self.__num_saved]
+        data['twoots'] = unsaved + data['twoots']
+        self.__num_saved = len(self.twoots)
+
+        # drop the twoots whose posts are deleted
+        if len(self.deleted_twoots) > 0:
+            deleted = set((t['toot_id'], t['tweet_id'])
+                          for t in self.deleted_twoots)
+            data['twoots'] = [
+                t for t in data['twoots']
+                if (t['toot_id'], t['tweet_id']) not in deleted
+            ]
 
         # keep the number of stored twoots less than max_twoots
         data['twoots'] = data['twoots'][:self.config['max_twoots']]
 
         # save data
-        with open(self.data_file, 'wb') as f:
-            pickle.dump(data, f)
+        self.__write_data(data)
+
+    def __is_leader(self):
+        """Returns True unless this node has lost the lease in HA mode.
+
+        The lease is renewed on every call, i.e., right before each publish,
+        delete, and edit.
+        """
+        if self.lease is None:
+            return True
+
+        if self.lease.renew():
+            return True
+
+        logger.warn('Lost the lease; stop forwarding')
+        return False
+
+    def __after_forward(self, dry_run, update=False, key=None, post_id=None):
+        """Save forwarded twoots (and the last id) immediately in HA mode.
+
+        This makes sure that the standby never forwards them again even if
+        this node is gone right after, and that it takes over the posts not
+        processed yet.
+
+        Args:
+            dry_run (bool): the flag
+            update (bool): the flag
+            key (str): the last id to update ('last_toot' or 'last_tweet')
+            post_id (int): Id of the processed post
+        """
+        if self.lease is None:
+            return
+
+        if not dry_run and len(self.twoots) > self.__num_saved:
+            self.__save_data()
+
+        if key is not None and (not dry_run or update):
+            self.__update_last_id(key, post_id)
+
+    def run(self, dry_run=False, update=False, profiler=None, resync=None):
+        checkpoint = profiler.checkpoint if profiler else lambda label: None
 
-    def run(self, dry_run=False, update=False):
         if dry_run:
             if self.setup:
                 logger.warn(
@@ -1005,29 +3432,275 @@ class Twoot:
         else:
             logger.debug('Running')
 
-        # tweets -> toots
-        toots = self.get_new_toots(dry_run, update)
+        # only the leader forwards posts in HA mode
+        if self.lease is not None and not self.lease.acquire():
+            logger.info('Standing by; the lease is held by {}'.format(
+                self.lease.holder()))
+            return
+
+        # defer everything while the APIs seem down
+        down = []
         if not self.setup:
-            self.toots2tweets(toots, dry_run)
+            down = [h for h in self.api_hosts if self.circuits.is_open(h)]
+        if len(down) > 0:
+            logger.warn('Deferring sync because {} seem(s) down'.format(
+                ', '.join(down)))
+
+        def due(direction):
+            if len(down) > 0 or resync is not None:
+                return False
+            if self.setup or self.scheduler is None:
+                return True
+            if self.scheduler.due(direction):
+                return True
+            logger.debug('Not yet time to poll {}'.format(direction))
+            return False
+
+        # tweets -> toots
+        if due('toots'):
+            toots = self.get_new_toots(dry_run, update)
+            checkpoint('fetching toots')
+            if not self.setup:
+                self.toots2tweets(toots, dry_run, update)
+                checkpoint('processing toots')
 
         # toots -> tweets
-        tweets = self.get_new_tweets(dry_run, update)
-        if not self.setup:
-            self.tweets2toots(tweets, dry_run)
+        if due('tweets'):
+            tweets = self.get_new_tweets(dry_run, update)
+            checkpoint('fetching tweets')
+            if not self.setup:
+                self.tweets2toots(tweets, dry_run, update)
+                checkpoint('processing tweets')
+
+        # re-sync the window (since, until, ranges)
+        if resync is not None and not self.setup and not down:
+            self.resync(*resync, dry_run=dry_run, update=update)
+            checkpoint('re-syncing')
+
+        # count up filter hits
+        if len(self.filter_hits) > 0:
+            hits = dict(self.data.get('filter_hits', {}))
+            for name, n in self.filter_hits.items():
+                hits[name] = hits.get(name, 0) + n
+            log_event(log.DEBUG, 'filter.hits', 'Filter hits: %s',
+                      self.filter_hits, hits=self.filter_hits)
+            if not dry_run or update:
+                self.__update_last_id('filter_hits', hits)
+
+        # keep the learned mentions
+        if self.mentions is not None and self.mentions.dirty and \
+                (not dry_run or update):
+            self.mentions.prune()
+            self.__update_last_id('mention_cache', self.mentions.cache)
+
+        # deleted posts -> deleted paired posts
+        if not self.setup and not down and 'delete_sync' in self.config \
+                and resync is None and self.__is_leader():
+            self.sync_deletions(dry_run, update)
 
         # update the entire data
-        if len(self.twoots) > 0:
+        if len(self.twoots) > self.__num_saved or \
+                len(self.deleted_twoots) > 0:
             logger.debug('Saving up-to-dated data to {}'.format(
                 self.data_file))
             self.__save_data()
+            checkpoint('saving data')
 
         # show current status for debugging
         logger.debug('Number of stored twoots: {}'.format(
             len(self.data['twoots'])))
 
+        # no more media to transform
+        self.media_transformer.shutdown()
+
+        # keep the state of circuits for the next run
+        if not self.setup:
+            self.circuits.join_probes()
+            # only the open circuits; the others are just closed
+            circuits = self.circuits.open_circuits()
+            if circuits != self.data.get('circuits', {}):
+                self.__update_last_id('circuits', circuits)
+
+
+# profiling
+class RunProfiler:
+    """CPU and memory profiler of runs.
+
+    The CPU profile (cProfile) of a run is dumped to `cpu_file` in the pstats
+    format. For memory, snapshots of tracemalloc are taken at checkpoints in
+    a run, and the top allocators since the previous checkpoint, the traced
+    memory, and the peak RSS are reported. Note that tracemalloc traces the
+    whole process, i.e., all profiles running in parallel.
+
+    Args:
+        cpu_file (str): the pstats file (None for no CPU profiling)
+        memory (bool): enable memory profiling
+        top (int): the number of top allocators to report
+    """
+
+    def __init__(self, cpu_file=None, memory=False, top=10):
+        self.cpu_file = cpu_file
+        self.memory = memory
+        self.top = top
+        self.__cpu = None
+        self.__snapshot = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        if self.cpu_file:
+            self.__cpu = cProfile.Profile()
+            self.__cpu.enable()
+
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.__snapshot = self.__take_snapshot()
+
+    @staticmethod
+    def __take_snapshot():
+        return tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__), ))
+
+    def checkpoint(self, label):
+        """Report the memory usage at the checkpoint `label`."""
+        if not self.memory or self.__snapshot is None:
+            return
+
+        snapshot = self.__take_snapshot()
+        stats = snapshot.compare_to(self.__snapshot, 'lineno')
+        self.__snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            rss *= 1024  # KiB in Linux
+
+        log_event(log.INFO,
+                  'profile.memory',
+                  'Memory after %s: %.1f MiB traced (peak %.1f MiB), '
+                  'peak RSS %.1f MiB',
+                  label,
+                  current / 2**20,
+                  peak / 2**20,
+                  rss / 2**20,
+                  checkpoint=label,
+                  traced=current,
+                  traced_peak=peak,
+                  peak_rss=rss)
+        for st in stats[:self.top]:
+            log_event(log.INFO,
+                      'profile.allocator',
+                      '  %s',
+                      st,
+                      checkpoint=label,
+                      allocator=str(st.traceback),
+                      size_diff=st.size_diff)
+
+    def stop(self):
+        if self.__cpu is not None:
+            self.__cpu.disable()
+            self.__cpu.dump_stats(self.cpu_file)
+            logger.info('Dumped CPU profile to {}'.format(self.cpu_file))
+            self.__cpu = None
+
+        self.__snapshot = None
+
+
+# statistics
+LAG_COMPONENTS = ['total', 'queue', 'media', 'publish']
+LAG_BUCKETS = [1, 2, 5, 10, 30, 60, 120, 300, 900, 3600]
+
+
+def _percentile(values, p):
+    """Returns the `p`-th percentile of sorted `values` (nearest rank)."""
+    k = max(0, int(math.ceil(p / 100 * len(values))) - 1)
+    return values[k]
+
+
+def _format_seconds(sec):
+    if abs(sec) < 60:
+        return '{:.1f}s'.format(sec)
+    elif abs(sec) < 3600:
+        return '{:.1f}m'.format(sec / 60)
+    else:
+        return '{:.1f}h'.format(sec / 3600)
+
+
+def lag_stats(twoots):
+    """Collect the sync lags of `twoots` for each direction.
+
+    Args:
+        twoots (list): twoot dicts
+
+    Returns:
+        dict: sorted lists of each lag component for each direction
+    """
+    res = {}
+    for t in twoots:
+        lag = t.get('lag', None)
+        if lag is None:
+            continue
+
+        direction = {'toot': 'toots -> tweets', 'tweet': 'tweets -> toots'}
+        lags = res.setdefault(direction[t['origin']],
+                              {c: []
+                               for c in LAG_COMPONENTS})
+        for c in LAG_COMPONENTS:
+            lags[c].append(lag[c])
+
+    for lags in res.values():
+        for values in lags.values():
+            values.sort()
+
+    return res
+
+
+def print_stats(profile, twoots):
+    """Print percentiles and a histogram of sync lags of `twoots`."""
+    print('Profile: {}'.format(profile))
+    stats = lag_stats(twoots)
+    if not stats:
+        print('  No sync lags recorded')
+
+    percentiles = [50, 90, 95, 99, 100]
+    for direction, lags in sorted(stats.items()):
+        print('\n  {} ({} posts)'.format(direction, len(lags['total'])))
+        print('    {:<8}'.format('') + ''.join('{:>8}'.format(
+            'p{}'.format(p) if p < 100 else 'max') for p in percentiles))
+        for c in LAG_COMPONENTS:
+            print('    {:<8}'.format(c) + ''.join('{:>8}'.format(
+                _format_seconds(_percentile(lags[c], p)))
+                                          for p in percentiles))
+
+        # histogram of total lags
+        counts = [0] * (len(LAG_BUCKETS) + 1)
+        for v in lags['total']:
+            i = 0
+            while i < len(LAG_BUCKETS) and v > LAG_BUCKETS[i]:
+                i += 1
+            counts[i] += 1
+
+        print()
+        width = 40 / max(counts)
+        labels = ['<= ' + _format_seconds(b) for b in LAG_BUCKETS]
+        labels.append('> ' + _format_seconds(LAG_BUCKETS[-1]))
+        for label, n in zip(labels, counts):
+            bar = '#' * int(math.ceil(n * width))
+            print('    {:<9} {:>5} {}'.format(label, n, bar).rstrip())
+
 
 # the application
-def set_logger(log_level, log_file):
+def set_logger(log_level,
+               log_file,
+               log_format='text',
+               sampling=None,
+               show_profile=False):
     # log level
     if log_level == 0:
         level = log.WARN
@@ -1036,38 +3709,184 @@ def set_logger(log_level, log_file):
     else:
         level = log.INFO
 
+    # distinguish messages of profiles running in parallel
+    name = '%(name)s[%(profile)s]' if show_profile else '%(name)s'
+
     # log file
     if log_file:
         handler = RotatingFileHandler(log_file,
                                       maxBytes=5000000,
                                       backupCount=9)
-        formatter = log.Formatter(
-            '%(asctime)s - %(name)s %(levelname)s: %(message)s')
+        formatter = log.Formatter('%(asctime)s - ' + name +
+                                  ' %(levelname)s: %(message)s')
     else:
         handler = log.StreamHandler()
-        formatter = log.Formatter('%(name)s %(levelname)s: %(message)s')
+        formatter = log.Formatter(name + ' %(levelname)s: %(message)s')
+
+    # structured output
+    if log_format == 'json':
+        formatter = JsonFormatter()
 
     # apply settings
     handler.setLevel(level)
     handler.setFormatter(formatter)
+    handler.addFilter(ContextFilter())
+    if sampling:
+        handler.addFilter(EventSampler(sampling))
 
     logger.setLevel(level)
     logger.addHandler(handler)
     logger.propagate = False
 
 
+def run_profile(profile,
+                setup,
+                dry_run,
+                update,
+                cassette=None,
+                watch=False,
+                interval=60,
+                cpu_file=None,
+                memory=False,
+                resync=None):
+    """Run twoot actions for a profile under its own lock.
+
+    In the watch mode, the actions are repeated until interrupted. The wait
+    between the cycles is given by the adaptive polling if it is enabled,
+    otherwise `interval` seconds.
+
+    Args:
+        profile (str): the profile name
+        setup (bool): setup mode
+        dry_run (bool): the flag
+        update (bool): the flag
+        cassette (Cassette): record or replay HTTP exchanges
+        watch (bool): the flag
+        interval (float): the polling interval for the watch mode
+        cpu_file (str): dump CPU profile of each run to the file
+        memory (bool): report memory usage of each run
+        resync (tuple): re-sync the window (since, until, ranges) instead
+
+    Returns:
+        dict: the result (profile, status, forwarded, and elapsed)
+    """
+    _log_context.profile = profile
+    res = {'profile': profile, 'status': 'ok', 'forwarded': 0, 'elapsed': 0}
+    start = time.time()
+
+    # make sure to be a singleton for each profile
+    lf = os.path.expanduser('~/.{}/{}.lock'.format(PROG_NAME, profile))
+    with open(lf, 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except IOError:
+            logger.debug('Process already exists')
+            res['status'] = 'locked'
+            return res
+
+        # execute twoot actions
+        try:
+            cycle = 0
+            while True:
+                # profile each cycle separately
+                cycle_file = cpu_file
+                if cpu_file and watch:
+                    cycle_file = '{}.{}'.format(cpu_file, cycle)
+                profiler = RunProfiler(cycle_file, memory)
+                cycle += 1
+
+                try:
+                    twoot = Twoot(profile, setup, cassette)
+                    with profiler:
+                        twoot.run(dry_run, update, profiler, resync)
+                    res['forwarded'] += len(
+                        [t for t in twoot.twoots if not t.get('part', False)])
+                    wait = interval
+                    if twoot.scheduler is not None:
+                        wait = twoot.scheduler.wait()
+
+                except Exception as e:
+                    logger.exception('Failed to run profile {}: {}'.format(
+                        profile, e))
+                    res['status'] = 'failed'
+                    wait = interval
+
+                if not watch or setup:
+                    break
+
+                logger.debug('Waiting {:.0f} sec for the next poll'.format(
+                    wait))
+                time.sleep(wait)
+
+        finally:
+            res['elapsed'] = time.time() - start
+            del _log_context.profile
+
+    return res
+
+
 def main():
     """The main function.
 
     1. parse command line options
     2. setup the logger
-    3. execute twoot actions (make sure to be a singleton)
+    3. execute twoot actions for each profile (make sure to be a singleton)
+    4. summarize the results
+
+    Returns:
+        int: exit code (0: success, 1: partial failure, 2: total failure)
     """
     # parse options
     args = docopt(HELP, version=VERSION)
     setup = args['--setup']
     dry_run, update = args['--dry-run'], args['--update']
-    profile = args['--profile'] or 'default'
+    jobs = int(args['--jobs'])
+    if jobs < 1:
+        print('Option --jobs must be a positive integer')
+        return 2
+    watch, interval = args['--watch'], float(args['--interval'])
+    cpu_file, memory = args['--profile-cpu'], args['--profile-memory']
+
+    resync = None
+    if args['--resync']:
+        if setup or watch:
+            print('Option --resync is exclusive with --setup and --watch')
+            return 2
+        try:
+            since, until = _parse_window(args['--resync'])
+        except ValueError as e:
+            print(e)
+            return 2
+        resync = (since, until, max(1, int(args['--resync-ranges'])))
+
+    # select profiles
+    twoot_dir = os.path.expanduser('~/.' + PROG_NAME)
+    if not os.path.isdir(twoot_dir):
+        os.mkdir(twoot_dir)
+
+    if args['--all-profiles']:
+        profiles = sorted(
+            os.path.basename(p)[:-len('.json')]
+            for p in glob.glob(os.path.join(twoot_dir, '*.json')))
+    elif args['--profiles']:
+        profiles = [p.strip() for p in args['--profiles'].split(',')]
+    else:
+        profiles = [args['--profile'] or 'default']
+
+    if not profiles:
+        print('No profiles found in {}'.format(twoot_dir))
+        return 2
+
+    if setup and len(profiles) > 1:
+        print('Setup mode is available only for a single profile')
+        return 2
+
+    # cProfile profiles only one thread at a time
+    if cpu_file and len(profiles) > 1 and (jobs > 1 or watch):
+        print('Option --profile-cpu is not available for profiles running '
+              'in parallel (--jobs or --watch)')
+        return 2
 
     # setup the logger
     log_level = 1  # info (default)
@@ -1078,21 +3897,113 @@ def main():
 
     log_file = args['--log']  # output messages stderr as default
 
-    set_logger(log_level, log_file)
-
-    # make sure to be a singleton
-    lf = os.path.expanduser('~/.' + PROG_NAME + '/lockfile.lock')
-    with open(lf, 'w') as f:
-        try:
-            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-
-            # execute twoot actions
-            twoot = Twoot(profile, setup)
-            twoot.run(dry_run, update)
+    log_format = args['--log-format']
+    if log_format not in ('text', 'json'):
+        print('Unknown log format: {}'.format(log_format))
+        return 2
 
-        except IOError:
-            logger.debug('Process already exists')
+    # e.g., "toot.processing=0.1,tweet.processing=0.1"
+    sampling = {}
+    if args['--log-sample']:
+        for spec in args['--log-sample'].split(','):
+            try:
+                event, rate = spec.split('=')
+                rate = float(rate)
+            except ValueError:
+                print('Invalid sampling spec: {}'.format(spec))
+                return 2
+            if not 0 <= rate <= 1:
+                print('Sampling rate must be in [0, 1]: {}'.format(spec))
+                return 2
+            sampling[event.strip()] = rate
+
+    set_logger(log_level, log_file, log_format, sampling, len(profiles) > 1)
+
+    # only show the statistics
+    if args['--stats']:
+        for p in profiles:
+            data_file = os.path.join(twoot_dir, p + '.pickle')
+            config_file = os.path.join(twoot_dir, p + '.json')
+            if os.path.isfile(config_file):
+                with open(config_file) as f:
+                    data_file = json.load(f).get('data_file', data_file)
+            twoots = []
+            if os.path.isfile(data_file):
+                with open(data_file, 'rb') as f:
+                    twoots = pickle.load(f)['twoots']
+            print_stats(p, twoots)
+        return 0
+
+    # record or replay HTTP exchanges
+    cassette = None
+    if args['--record'] and args['--replay']:
+        print('Options --record and --replay are exclusive')
+        return 2
+    elif args['--record']:
+        cassette = Cassette(args['--record'])
+    elif args['--replay']:
+        cassette = Cassette(args['--replay'],
+                            replay=True,
+                            latency_scale=float(args['--latency-scale']))
+
+    # setup mode is never entered implicitly for multiple profiles
+    results = []
+    if len(profiles) > 1:
+        for p in profiles:
+            if not os.path.isfile(os.path.join(twoot_dir, p + '.json')):
+                logger.error('No config found for profile {}'.format(p))
+                results.append({
+                    'profile': p,
+                    'status': 'failed',
+                    'forwarded': 0,
+                    'elapsed': 0
+                })
+        profiles = [p for p in profiles if p not in
+                    [r['profile'] for r in results]]
+
+    # execute twoot actions
+    try:
+        if len(profiles) == 1 and not results:
+            results.append(
+                run_profile(profiles[0], setup, dry_run, update, cassette,
+                            watch, interval, cpu_file, memory, resync))
+        elif profiles:
+            logger.debug('Running {} profiles with {} jobs'.format(
+                len(profiles), jobs))
+            # watching profiles never finish; run all of them at once
+            if watch:
+                jobs = len(profiles)
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    executor.submit(
+                        run_profile, p, setup, dry_run, update, cassette,
+                        watch, interval,
+                        cpu_file and '{}.{}'.format(cpu_file, p), memory,
+                        resync)
+                    for p in profiles
+                ]
+                results += [f.result() for f in futures]
+
+    finally:
+        if cassette is not None:
+            cassette.save()
+
+    # summary
+    failed = [r for r in results if r['status'] == 'failed']
+    if len(results) > 1:
+        for r in results:
+            logger.info('Profile {profile}: {status} '
+                        '({forwarded} forwarded, {elapsed:.1f}s)'.format(**r))
+        logger.info('Summary: {} profiles, {} failed'.format(
+            len(results), len(failed)))
+
+    if not failed:
+        return 0
+    elif len(failed) < len(results):
+        return 1
+    else:
+        return 2
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())